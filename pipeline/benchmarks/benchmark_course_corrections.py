@@ -0,0 +1,83 @@
+"""
+compares the previous correction path of clean_data (process.extract for every course + nested dict + DataFrame.apply(axis=1))
+with the current one (blocked fuzzy matching + flat lookup table + vectorized merge) on a synthetic review file.
+
+usage (from the pipeline directory): python benchmarks/benchmark_course_corrections.py [rows]
+"""
+import os
+import random
+import sys
+import time
+import pandas as pd
+from fuzzywuzzy import process
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../dags'))
+from data_cleaning.clean_data import course_corrections, correct_courses
+
+def synthetic_reviews(rows, departments=60, schools=3, seed=0):
+    """School ID/Department/Course Code columns with near-duplicate codes, like cleaned RateMyProfessors data"""
+    rng = random.Random(seed)
+    prefixes = ['CSE', 'MATH', 'CHEM', 'BIOL', 'PHYS', 'ECON', 'PSYCH', 'HIST', 'ENGL', 'PHIL']
+    department_codes = []
+    for department in range(departments):
+        prefix = prefixes[department % len(prefixes)]
+        numbers = [str(rng.randrange(100, 600)) for _ in range(40)] + [str(rng.randrange(1000, 5000)) for _ in range(10)]
+        codes = [prefix + number for number in numbers] + [prefix[:-1] + number for number in numbers[:5]] + [prefix + number + '1' for number in numbers[:5]]
+        department_codes.append((department % schools + 1, f'Department {department}', codes))
+
+    data = []
+    for _ in range(rows):
+        school_id, department, codes = department_codes[rng.randrange(departments)]
+        data.append((school_id, department, codes[min(int(rng.expovariate(0.08)), len(codes) - 1)]))
+    return pd.DataFrame(data, columns=['School ID', 'Department', 'Course Code']).astype({'Department': 'string', 'Course Code': 'string'})
+
+def legacy_similar_course_mapper(department):
+    """similar_course_mapper as it was before the blocking optimization: process.extract against every course of the department"""
+    unique_courses = department['Course Code'].unique()
+    course_map = {}
+
+    for course in unique_courses:
+        matches = process.extract(course, unique_courses)
+        similar_courses = [match for match, score in matches if score >= 92]
+
+        if similar_courses:
+            most_frequent_course = department[department['Course Code'].isin(similar_courses)]['Course Code'].mode()
+            if len(most_frequent_course) > 0:
+                for similar_course in similar_courses:
+                    course_map[similar_course] = most_frequent_course[0]
+
+    return course_map
+
+def legacy_correct_courses(row, corrections):
+    return corrections.get(row['Department'], {}).get(row['Course Code'], row['Course Code'])
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    data = synthetic_reviews(rows)
+    print(f'{rows:,} rows, {data["Department"].nunique()} departments, {data["Course Code"].nunique()} course codes')
+
+    # previous path: nested {department: {code: corrected}} dict, applied row by row
+    # (department names are unique across the synthetic schools, so grouping by department alone gives the same groups)
+    nested, legacy_build_seconds = timed(lambda: data.groupby('Department').apply(legacy_similar_course_mapper).to_dict())
+    legacy, legacy_apply_seconds = timed(data.apply, legacy_correct_courses, corrections=nested, axis=1)
+
+    # current path: flat lookup table, applied with one merge
+    corrections, build_seconds = timed(course_corrections, data)
+    vectorized, apply_seconds = timed(correct_courses, data, corrections)
+
+    if not (pd.Series(vectorized, dtype='string') == legacy.astype('string').reset_index(drop=True)).all():
+        raise AssertionError('vectorized corrections differ from the row-wise path')
+
+    print(f'{"":<24}{"build":>10}{"apply":>10}{"total":>10}')
+    print(f'{"row-wise (apply)":<24}{legacy_build_seconds:>9.2f}s{legacy_apply_seconds:>9.2f}s{legacy_build_seconds + legacy_apply_seconds:>9.2f}s')
+    print(f'{"vectorized (merge)":<24}{build_seconds:>9.2f}s{apply_seconds:>9.2f}s{build_seconds + apply_seconds:>9.2f}s')
+    print(f'build speedup: {legacy_build_seconds / build_seconds:.1f}x, apply speedup: {legacy_apply_seconds / apply_seconds:.0f}x, '
+          f'{len(corrections)} corrections')
+
+if __name__ == "__main__":
+    main()
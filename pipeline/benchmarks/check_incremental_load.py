@@ -0,0 +1,113 @@
+"""
+checks store_data's incremental load against a local DuckDB stand-in of the warehouse: two consecutive loads, the second
+with changed, new and removed rows (a removed review, class and professor, so deletes run children first), must leave
+the tables holding exactly the second load, and a third, unchanged load must stage nothing.
+
+usage (from the pipeline directory): python benchmarks/check_incremental_load.py
+"""
+import os
+import sys
+import tempfile
+import duckdb
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../dags'))
+from data_storage.sql_loader import TABLE_KEYS, delta_rows, duckdb_writer, incremental_load, load_state
+from data_storage.store_data import TABLE_COLUMNS, table_creation_queries
+
+def synthetic_tables(reviews=200, classes=12, professors=8):
+    """normalized tables as built by store_data.organize_data"""
+    class_ids = range(1, classes + 1)
+    professor_ids = range(1, professors + 1)
+    review_ids = range(1, reviews + 1)
+    return {
+        'SCHOOLS': pd.DataFrame({'SCHOOL_ID': [1, 2], 'SCHOOL_NAME': ['School 1', 'School 2']}),
+        'DEPARTMENTS': pd.DataFrame({'DEPARTMENT_ID': [1, 2, 3], 'DEPARTMENT_NAME': ['Math', 'Physics', 'Math']}),
+        'PROFESSORS': pd.DataFrame({
+            'PROFESSOR_ID': professor_ids,
+            'PROFESSOR_NAME': [f'Professor {id_}' for id_ in professor_ids],
+            'OVERALL_QUALITY': [3.5] * professors,
+            'OVERALL_DIFFICULTY': [2.5] * professors,
+        }),
+        'CLASSES': pd.DataFrame({
+            'CLASS_ID': class_ids,
+            'SCHOOL_ID': [1 if id_ <= classes // 2 else 2 for id_ in class_ids],
+            'DEPARTMENT_ID': [1 + id_ % 2 if id_ <= classes // 2 else 3 for id_ in class_ids],
+            'COURSE_CODE': [f'MATH{100 + id_}' for id_ in class_ids],
+        }),
+        'REVIEWS': pd.DataFrame({
+            'REVIEW_ID': review_ids,
+            'CLASS_ID': [1 + id_ % classes for id_ in review_ids],
+            'PROFESSOR_ID': [1 + id_ % professors for id_ in review_ids],
+            'QUALITY': [float(1 + id_ % 5) for id_ in review_ids],
+            'DIFFICULTY': [float(1 + id_ % 4) for id_ in review_ids],
+            'REVIEW': [f'review {id_}' for id_ in review_ids],
+            'DATE': pd.to_datetime('2023-01-01') + pd.to_timedelta([id_ % 365 for id_ in review_ids], unit='D'),
+            'WOULD_TAKE_AGAIN': [id_ % 2 == 0 for id_ in review_ids],
+            'GRADE': ['A'] * reviews,
+            'ATTENDANCE': ['Mandatory'] * reviews,
+            'TEXTBOOK_USAGE': [id_ % 3 == 0 for id_ in review_ids],
+            'SENTIMENT_SCORE': [round(id_ % 11 / 10 - 0.5, 1) for id_ in review_ids],
+            'THUMBS_UP': [id_ % 7 for id_ in review_ids],
+            'THUMBS_DOWN': [id_ % 3 for id_ in review_ids],
+        }),
+        'CLASS_INSTRUCTORS': pd.DataFrame(
+            sorted({(1 + id_ % classes, 1 + id_ % professors) for id_ in review_ids}), columns=['CLASS_ID', 'PROFESSOR_ID']
+        ),
+    }
+
+def next_load(tables):
+    """the same tables a run later: edited reviews and professors, new reviews, and one class and one professor gone"""
+    tables = {table_name: dataframe.copy() for table_name, dataframe in tables.items()}
+    removed_class = tables['CLASSES']['CLASS_ID'].max()
+    removed_professor = tables['PROFESSORS']['PROFESSOR_ID'].max()
+
+    reviews = tables['REVIEWS']
+    reviews.loc[reviews['REVIEW_ID'] % 10 == 0, 'QUALITY'] = 5.0
+    new_reviews = reviews.tail(5).assign(REVIEW_ID=reviews['REVIEW_ID'].max() + pd.RangeIndex(1, 6), CLASS_ID=1, PROFESSOR_ID=1)
+    reviews = pd.concat([reviews, new_reviews], ignore_index=True)
+    tables['REVIEWS'] = reviews[(reviews['CLASS_ID'] != removed_class) & (reviews['PROFESSOR_ID'] != removed_professor)].reset_index(drop=True)
+
+    tables['PROFESSORS'].loc[0, 'OVERALL_QUALITY'] = 4.5
+    tables['PROFESSORS'] = tables['PROFESSORS'][tables['PROFESSORS']['PROFESSOR_ID'] != removed_professor].reset_index(drop=True)
+    tables['CLASSES'] = tables['CLASSES'][tables['CLASSES']['CLASS_ID'] != removed_class].reset_index(drop=True)
+    instructors = tables['CLASS_INSTRUCTORS']
+    tables['CLASS_INSTRUCTORS'] = instructors[(instructors['CLASS_ID'] != removed_class) & (instructors['PROFESSOR_ID'] != removed_professor)].reset_index(drop=True)
+    return tables
+
+def check_tables(conn, tables):
+    """every table holds exactly the rows of `tables`"""
+    for table_name, expected in tables.items():
+        keys = TABLE_KEYS[table_name]
+        columns = TABLE_COLUMNS[table_name]
+        actual = conn.execute(f'SELECT {", ".join(columns)} FROM {table_name} ORDER BY {", ".join(keys)}').df()
+        actual.columns = [column.upper() for column in actual.columns]
+        expected = expected[columns].sort_values(keys).reset_index(drop=True)
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+def main():
+    conn = duckdb.connect()
+    for query in table_creation_queries(foreign_keys=False).values():
+        conn.execute(query)
+    state_dir = tempfile.mkdtemp()
+    write_dataframe = duckdb_writer(conn)
+
+    first = synthetic_tables()
+    incremental_load(conn, first, write_dataframe, state_dir)
+    check_tables(conn, first)
+    print('first load: every row loaded')
+
+    second = next_load(first)
+    incremental_load(conn, second, write_dataframe, state_dir)
+    check_tables(conn, second)
+    print('second load: changed, new and removed rows applied')
+
+    staged = sum(len(delta_rows(table_name, dataframe, load_state(state_dir, table_name))) for table_name, dataframe in second.items())
+    if staged:
+        raise AssertionError(f'an unchanged load stages {staged} rows')
+    incremental_load(conn, second, write_dataframe, state_dir)
+    check_tables(conn, second)
+    print('third load: nothing staged')
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,193 @@
 import pandas as pd
-from fuzzywuzzy import process
-import os
+from collections import Counter, defaultdict
+from fuzzywuzzy import fuzz, utils
+import heapq
 import logging
+from utils import reviews_io
+from utils.instrumentation import current_metrics, instrumented
+from utils.manifests import content_addressed
+from utils.reviews_io import CLEANED, raw_reviews_file_path, read_raw_reviews, reviews_file_path, write_reviews
+
+# course codes scoring at least this much (out of 100) are grouped together
+SIMILARITY_THRESHOLD = 92
+
+# number of best matches considered per course, same as fuzzywuzzy's process.extract default
+MATCH_LIMIT = 5
+
+# raw reviews.csv column -> cleaned column
+RENAMED_COLUMNS = {
+    'School ID': 'SCHOOL_ID',
+    'School Name': 'SCHOOL_NAME',
+    'Professor ID': 'PROFESSOR_ID',
+    'Professor Name': 'PROFESSOR_NAME',
+    'Overall Quality': 'OVERALL_QUALITY',
+    'Overall Difficulty': 'OVERALL_DIFFICULTY',
+    'Department': 'DEPARTMENT_NAME',
+    'Review ID': 'REVIEW_ID',
+    'Course Code': 'COURSE_CODE',
+    'Review Date': 'DATE',
+    'Quality': 'QUALITY',
+    'Difficulty': 'DIFFICULTY',
+    'Review Text': 'REVIEW',
+    'Would Take Again': 'WOULD_TAKE_AGAIN',
+    'Grade': 'GRADE',
+    'Attendance': 'ATTENDANCE',
+    'Textbook Usage': 'TEXTBOOK_USAGE',
+    'Thumbs Up': 'THUMBS_UP',
+    'Thumbs Down': 'THUMBS_DOWN',
+}
+
+def length_bound(length_a, length_b):
+    """
+    upper bound on fuzz.WRatio for two different single-token strings of these lengths:
+    every ratio WRatio takes the max of is at most 200 * shorter / (shorter + longer)
+    """
+    shorter, longer = sorted((length_a, length_b))
+    return 200 * shorter / (shorter + longer)
+
+def character_bound(counts_a, counts_b, length_a, length_b):
+    """
+    tighter bound for the same strings: the characters two strings have in common cap how many can ever be matched,
+    so every ratio is at most 200 * common characters / (length_a + length_b)
+    """
+    return 200 * sum((counts_a & counts_b).values()) / (length_a + length_b)
 
 def similar_course_mapper(department):
     """
     uses fuzzy matching NLP to group Course Code within each department that share at least a 92% similarity.
-    standardizes course codes to a single common course code, if they're similar enough
+    standardizes course codes to a single common course code, if they're similar enough.
+
+    produces the same mapping as running process.extract(course, unique_courses) for every course, but each code is
+    preprocessed once, candidates are blocked by length and shared characters so only pairs that can reach the threshold
+    are scored, and course frequencies are counted once instead of once per course
     """
 
-    unique_courses = department['Course Code'].unique()
+    unique_courses = list(department['Course Code'].unique())
+    course_counts = department['Course Code'].value_counts()
+    processed_courses = [utils.full_process(course, force_ascii=True) for course in unique_courses]
+    character_counts = [Counter(processed) for processed in processed_courses]
+
+    # block single-token codes by processed length: scores are rounded, so a pair can only reach the threshold
+    # if its length bound is at least SIMILARITY_THRESHOLD - 0.5. multi-token codes are always scored
+    courses_by_length = defaultdict(list)
+    multi_token_courses = []
+    for index, processed in enumerate(processed_courses):
+        if ' ' in processed:
+            multi_token_courses.append(index)
+        else:
+            courses_by_length[len(processed)].append(index)
+
     course_map = {}
-    
-    for course in unique_courses:
+
+    for index, course in enumerate(unique_courses):
+        processed = processed_courses[index]
+        if ' ' in processed:
+            candidates = range(len(unique_courses))
+        else:
+            # candidates keep the order of unique_courses, so ties are broken exactly like process.extract
+            candidates = sorted(multi_token_courses + [
+                candidate
+                for length, indices in courses_by_length.items()
+                if length_bound(len(processed), length) >= SIMILARITY_THRESHOLD - 0.5
+                for candidate in indices
+                if character_bound(character_counts[index], character_counts[candidate], len(processed), length) >= SIMILARITY_THRESHOLD - 0.5
+            ])
+
         # find the closest matches to each course within the department
-        matches = process.extract(course, unique_courses)
+        matches = [
+            (unique_courses[candidate], fuzz.WRatio(processed, processed_courses[candidate], full_process=False))
+            for candidate in candidates
+        ]
+        matches = heapq.nlargest(MATCH_LIMIT, matches, key=lambda match: match[1])
+
         # group courses together if they have a similarity score >= 92/100%
-        similar_courses = [match for match, score in matches if score >= 92]
-        
+        similar_courses = [match for match, score in matches if score >= SIMILARITY_THRESHOLD]
+
         if similar_courses:
             # if a similar course grouping exists --> the new course code will be the most popular course code of that group
-            most_frequent_course = department[department['Course Code'].isin(similar_courses)]['Course Code'].mode()
-            if len(most_frequent_course) > 0:
-                most_frequent_course_value = most_frequent_course[0]
-                for similar_course in similar_courses:
-                    course_map[similar_course] = most_frequent_course_value
-                    
+            # (ties go to the alphabetically first code, like Series.mode()[0])
+            most_frequent_count = max(course_counts[similar_course] for similar_course in similar_courses)
+            most_frequent_course_value = min(similar_course for similar_course in similar_courses if course_counts[similar_course] == most_frequent_count)
+            for similar_course in similar_courses:
+                course_map[similar_course] = most_frequent_course_value
+
     return course_map
 
-def correct_courses(row, corrections):
-    return corrections.get(row['Department'], {}).get(row['Course Code'], row['Course Code'])
+def course_corrections(data):
+    """
+    flat (School ID, Department, Course Code) -> Corrected Course Code lookup table built from similar_course_mapper.
+    courses are only grouped within a department of the same school, so every school can be cleaned on its own.
+    only codes that change are listed
+    """
+    corrections = [
+        (school_id, department, course, corrected_course)
+        for (school_id, department), courses in data.groupby(['School ID', 'Department'])[['Course Code']]
+        for course, corrected_course in similar_course_mapper(courses).items()
+        if course != corrected_course
+    ]
+    return pd.DataFrame(corrections, columns=['School ID', 'Department', 'Course Code', 'Corrected Course Code']).astype({
+        'School ID': data['School ID'].dtype, 'Department': data['Department'].dtype,
+        'Course Code': data['Course Code'].dtype, 'Corrected Course Code': data['Course Code'].dtype
+    })
 
-def clean_data():
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    reviews_file_path = os.path.join(current_directory, '../reviews.csv')
-    data = pd.read_csv(reviews_file_path)
-    
+def correct_courses(data, corrections):
+    """applies the corrections table to every row with one vectorized left merge, keeping codes without a correction"""
+    keys = ['School ID', 'Department', 'Course Code']
+    corrected = data[keys].merge(corrections, on=keys, how='left')
+    return corrected['Corrected Course Code'].fillna(corrected['Course Code']).to_numpy()
+
+def assign_ids(data):
+    """
+    adds DEPARTMENT_ID and CLASS_ID, scoped to the school: the same department or course code at two schools gets two ids.
+    ids are ranks of the sorted (school, department[, course code]) keys, so they only depend on the set of keys:
+    assigning them after merging cleaned shards gives the same ids as cleaning everything at once
+    """
+    # create department_id by auto-incrementing on unique (school, department name) pairs
+    data['DEPARTMENT_ID'] = data.groupby(['SCHOOL_ID', 'DEPARTMENT_NAME'], sort=True, dropna=False).ngroup() + 1
+
+    # create class_id by auto-incrementing on unique (school, department name, course code) triples
+    data['CLASS_ID'] = data.groupby(['SCHOOL_ID', 'DEPARTMENT_NAME', 'COURSE_CODE'], sort=True, dropna=False).ngroup() + 1
+    return data
+
+@instrumented('clean_data')
+@content_addressed(
+    'clean_data',
+    inputs=lambda arguments: [raw_reviews_file_path(arguments['run_id'], arguments['shard'])],
+    outputs=lambda arguments: [reviews_file_path(CLEANED, arguments['run_id'], arguments['shard'])],
+    modules=[reviews_io],
+    packages=['pandas', 'fuzzywuzzy']
+)
+def clean_data(shard=None, run_id=None):
+    """
+    cleans the run's collected reviews.csv into the run's cleaned reviews file.
+    with a shard, only that shard's reviews are cleaned and ids are left to merge_shards
+    """
+    metrics = current_metrics()
+    data = read_raw_reviews(run_id, shard)
+
+    with metrics.step('regex_filtering'):
+        data = filter_course_codes(data)
+
+    # standardizes course codes by department
+    with metrics.step('fuzzy_grouping'):
+        corrections = course_corrections(data)
+
+    # correct course codes
+    with metrics.step('correct_courses'):
+        data['Course Code'] = correct_courses(data, corrections)
+
+    # rename all columns
+    data.rename(columns=RENAMED_COLUMNS, inplace=True)
+
+    if shard is None:
+        assign_ids(data)
+
+    # save clean data
+    write_reviews(data, CLEANED, run_id=run_id, shard=shard)
+    logging.info('Reviews have been successfully cleaned')
+
+def filter_course_codes(data):
+    """uppercases course codes, keeps rows whose code has the expected format and drops the trailing course type letter"""
     # convert course codes to uppercase
     data['Course Code'] = data['Course Code'].str.upper()
 
@@ -53,46 +205,7 @@ def clean_data():
     # remove trailing letters from the Course Code
     # Example: CHEM111A --> CHEM111
     data['Course Code'] = data['Course Code'].str.replace(r'[A-Z]$', '', regex=True)
-
-    # standardizes course codes by department
-    course_corrections = data.groupby('Department').apply(similar_course_mapper).to_dict()
-    
-    # correct course codes
-    data['Course Code'] = data.apply(correct_courses, corrections=course_corrections, axis=1)
-
-    # rename all columns
-    data.rename(columns=
-        {
-            'School ID': 'SCHOOL_ID',
-            'School Name': 'SCHOOL_NAME',
-            'Professor ID': 'PROFESSOR_ID',
-            'Professor Name': 'PROFESSOR_NAME',
-            'Overall Quality': 'OVERALL_QUALITY',
-            'Overall Difficulty': 'OVERALL_DIFFICULTY',
-            'Department': 'DEPARTMENT_NAME',
-            'Review ID': 'REVIEW_ID',
-            'Course Code': 'COURSE_CODE',
-            'Review Date': 'DATE',
-            'Quality': 'QUALITY',
-            'Difficulty': 'DIFFICULTY',
-            'Review Text': 'REVIEW',
-            'Would Take Again': 'WOULD_TAKE_AGAIN',
-            'Grade': 'GRADE',
-            'Attendance': 'ATTENDANCE',
-            'Textbook Usage': 'TEXTBOOK_USAGE',
-            'Thumbs Up': 'THUMBS_UP',
-            'Thumbs Down': 'THUMBS_DOWN',
-        }, inplace=True)
-    
-    # create department_id by auto-incrementing on unique department names
-    data['DEPARTMENT_ID'] = data['DEPARTMENT_NAME'].astype('category').cat.codes + 1
-    
-    # create class_id by auto-incrementing on unique course_codes
-    data['CLASS_ID'] = data['COURSE_CODE'].astype('category').cat.codes + 1
-    
-    # save clean data
-    data.to_csv(reviews_file_path, index=False)
-    logging.info('Reviews have been successfully cleaned')
+    return data
 
 if __name__ == "__main__":
     clean_data()
@@ -1,91 +1,435 @@
-import requests
+import base64
 import json
 import csv
+import contextvars
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import fcntl
+import itertools
 import logging
 import os
+import shutil
+from data_collection.get_reviews.http_client import RatingsClient, ResponseCache
+from utils.instrumentation import current_metrics, instrumented
+from utils.manifests import file_hash
+from utils.reviews_io import COLLECTED, atomic_write, link_atomically, publish_raw_reviews, raw_reviews_file_path, stage_directory
 
-def get_reviews():
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    professors_file_path = os.path.join(current_directory, 'professors.json')
-    reviews_file_path = os.path.join(current_directory, '../../reviews.csv')
+# legacy RateMyProfessors ids of the schools to collect (1147 = Washington University in St. Louis)
+SCHOOL_IDS = [1147]
+
+# number of schools collected concurrently, their professors share the MAX_WORKERS fetch workers
+SCHOOL_WORKERS = 4
+
+# number of professors fetched concurrently (1 = serial)
+MAX_WORKERS = 8
+
+# professors per teacher search page during professor discovery
+PROFESSORS_PAGE_SIZE = 1000
+
+# per-host request cap shared by every worker (None = unlimited)
+REQUESTS_PER_SECOND = 10
+
+# (connect, read) timeout in seconds and retries per page for timeouts, connection errors, 429 and 5xx responses
+REQUEST_TIMEOUT = (5, 30)
+MAX_RETRIES = 5
+
+# on-disk cache of paginator responses, shared by every school (None = disabled)
+RESPONSE_CACHE_DIR = 'response_cache'
+RESPONSE_CACHE_TTL = 6 * 60 * 60
+RESPONSE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+FIELDNAMES = ['School ID', 'School Name', 'Professor ID', 'Professor Name', 'Overall Quality', 'Overall Difficulty', \
+            'Department', 'Review ID', 'Course Code', 'Review Date', 'Quality', 'Difficulty', 'Review Text', \
+                'Would Take Again', 'Grade', 'Attendance', 'Textbook Usage', 'Thumbs Up', 'Thumbs Down']
+
+# per-school state (professors.json, watermarks, snapshot and checkpoint), stored in schools/<school id>
+SCHOOLS_DIRECTORY = 'schools'
+PROFESSORS_FILE = 'professors.json'
+
+
+# incremental collection state, stored next to professors.json
+WATERMARKS_FILE = 'review_watermarks.json'
+SNAPSHOT_FILE = 'reviews_snapshot.csv'
+
+# progress of an unfinished run, saved every CHECKPOINT_INTERVAL professors
+CHECKPOINT_FILE = 'reviews_checkpoint.json'
+CHECKPOINT_INTERVAL = 50
+
+def school_legacy_id(school_node_id):
+    """legacy school id from a GraphQL school id, which is base64 of 'School-<legacy id>'"""
+    return int(base64.b64decode(school_node_id).decode('utf-8').split('-')[1])
+
+def professor_columns(professor_info):
+    """reviews.csv columns that describe the professor rather than the review"""
+    return {
+        'School ID': school_legacy_id(professor_info['school']['id']),
+        'School Name': professor_info['school']['name'],
+        'Professor ID': professor_info['legacyId'],
+        'Professor Name': f"{professor_info['firstName']} {professor_info['lastName']}",
+        'Overall Quality': professor_info['avgRating'],
+        'Overall Difficulty': professor_info['avgDifficulty'],
+        'Department': professor_info['department'],
+    }
+
+def parse_review(rating, professor_info):
+    """converts a single rating from the paginator into a reviews.csv row"""
+    return {
+        **professor_columns(professor_info),
+        'Review ID': rating['id'],
+        'Course Code': rating['rClass'],
+        'Review Date': datetime.strptime(rating['rDate'], '%m/%d/%Y').date(),
+        'Quality': rating['rOverall'],
+        'Difficulty': rating['rEasy'],
+        'Review Text': rating['rComments'].strip(),
+        'Would Take Again': True if rating.get('rWouldTakeAgain') == 'Yes' else (False if rating.get('rWouldTakeAgain') == 'No' else None),
+        'Grade': rating.get('teacherGrade', None),
+        'Attendance': rating.get('attendance', None),
+        'Textbook Usage': True if rating.get('rTextBookUse') == 'Yes' else (False if rating.get('rTextBookUse') == 'No' else None),
+        'Thumbs Up': rating['helpCount'],
+        'Thumbs Down': rating['notHelpCount'],
+    }
+
+def load_watermarks(watermarks_file_path):
+    """loads the newest review seen per professor (keyed by legacyId) from the previous run"""
+    if not os.path.exists(watermarks_file_path):
+        return {}
+
+    with open(watermarks_file_path, 'r') as file:
+        return json.load(file)
 
-    with open(professors_file_path, 'r') as file:
-        data = json.load(file)
-        professors = data["search"]["teachers"]["edges"]
+def write_json(data, file_path):
+    with atomic_write(file_path) as temp_file_path, open(temp_file_path, 'w') as file:
+        json.dump(data, file)
 
+def reached_watermark(rating, watermark):
+    """true once paging reaches a review that was already collected by a previous run (pages are newest first)"""
+    if watermark['id'] is None:
+        return False
+    if rating['id'] == watermark['id']:
+        return True
+    return datetime.strptime(rating['rDate'], '%m/%d/%Y') < datetime.strptime(watermark['rDate'], '%m/%d/%Y')
+
+def fetch_professor_reviews(client, count, professor, watermark=None):
+    """
+    fetches reviews for one professor, in page order.
+    with a watermark from a previous run, paging stops at the first already known review and
+    professors whose numRatings has not changed are skipped entirely. pages of a professor with new reviews are
+    revalidated with the server, so a cached page from before the new reviews is never taken as up to date.
+    returns (reviews, new watermark), where the watermark is None if the professor could not be fully fetched
+    """
+    professor_info = professor["node"]
+
+    print(f'Fetching Reviews for Professor #{count}: {professor_info["firstName"]} {professor_info["lastName"]}')
+    logging.info(f'Fetching Reviews for Professor #{count}: {professor_info["firstName"]} {professor_info["lastName"]}')
+
+    # get professor ID and number of ratings for grabbing reviews
+    professorID = professor_info['legacyId']
+    num_ratings = professor_info['numRatings']
+    page = 1
+    remaining_reviews = num_ratings
     reviews = []
 
-    for count, professor in enumerate(professors):
-        professor_info = professor["node"]
-
-        print(f'Fetching Reviews for Professor #{count}: {professor_info["firstName"]} {professor_info["lastName"]}')
-        logging.info(f'Fetching Reviews for Professor #{count}: {professor_info["firstName"]} {professor_info["lastName"]}')
-        
-        # get professor ID and number of ratings for grabbing reviews
-        professorID = professor_info['legacyId']
-        num_ratings = professor_info['numRatings']
-        page = 1
-        remaining_reviews = num_ratings
-
-        while remaining_reviews > 0:
-            url = f'https://www.ratemyprofessors.com/paginate/professors/ratings?tid={professorID}&page={page}'
-            response = requests.get(url)
-            
-            if response.status_code == 200:
-                print(f'Page {page}')
-                logging.info(f'Page {page}')
-
-                data = response.json()
-                ratings = data.get('ratings', [])
-                for rating in ratings:
-                    review = {
-                        'School ID': 1147, # rating['sId']
-                        'School Name': professor_info['school']['name'],
-                        'Professor ID': professorID,
-                        'Professor Name': f"{professor_info['firstName']} {professor_info['lastName']}",
-                        'Overall Quality': professor_info['avgRating'],
-                        'Overall Difficulty': professor_info['avgDifficulty'],
-                        'Department': professor_info['department'],
-                        'Review ID': rating['id'],
-                        'Course Code': rating['rClass'],
-                        'Review Date': datetime.strptime(rating['rDate'], '%m/%d/%Y').date(),
-                        'Quality': rating['rOverall'],
-                        'Difficulty': rating['rEasy'],
-                        'Review Text': rating['rComments'].strip(),
-                        'Would Take Again': True if rating.get('rWouldTakeAgain') == 'Yes' else (False if rating.get('rWouldTakeAgain') == 'No' else None),
-                        'Grade': rating.get('teacherGrade', None),
-                        'Attendance': rating.get('attendance', None),
-                        'Textbook Usage': True if rating.get('rTextBookUse') == 'Yes' else (False if rating.get('rTextBookUse') == 'No' else None),
-                        'Thumbs Up': rating['helpCount'],
-                        'Thumbs Down': rating['notHelpCount'],
-                    }
-                    reviews.append(review)
-                
-                # update remaining number of reviews
-                remaining_reviews = data.get('remaining', 0)
-                page += 1
-            else:
-                print(f'Error fetching page {page} for professorID {professorID}: {response.status_code}')
-                logging.info(f'Error fetching page {page} for professorID {professorID}: {response.status_code}')
-                break
-
-    # write everything to csv
-    with open(reviews_file_path, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['School ID', 'School Name', 'Professor ID', 'Professor Name', 'Overall Quality', 'Overall Difficulty', \
-                    'Department', 'Review ID', 'Course Code', 'Review Date', 'Quality', 'Difficulty', 'Review Text', \
-                        'Would Take Again', 'Grade', 'Attendance', 'Textbook Usage', 'Thumbs Up', 'Thumbs Down']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        
-        writer.writeheader()
-        for review in reviews:
-            writer.writerow(review)
-
-    print('Reviews have been successfully written to reviews.csv')
-    logging.info('Reviews have been successfully written to reviews.csv')
+    if watermark is not None and watermark['numRatings'] == num_ratings:
+        print(f'Skipping professorID {professorID}: no new reviews')
+        logging.info(f'Skipping professorID {professorID}: no new reviews')
+        return reviews, watermark
+
+    new_watermark = {'numRatings': num_ratings, 'id': None, 'rDate': None}
+    if watermark is not None:
+        new_watermark.update(id=watermark['id'], rDate=watermark['rDate'])
+
+    while remaining_reviews > 0:
+        status_code, data = client.fetch_page(professorID, page, revalidate=watermark is not None)
+
+        if status_code == 200:
+            print(f'Page {page} for professorID {professorID}')
+            logging.info(f'Page {page} for professorID {professorID}')
+
+            ratings = data.get('ratings', [])
+            for rating in ratings:
+                if watermark is not None and reached_watermark(rating, watermark):
+                    # only count the reviews actually seen: if some are still missing, the professor is fetched again next run
+                    new_watermark['numRatings'] = min(num_ratings, watermark['numRatings'] + len(reviews))
+                    return reviews, new_watermark
+
+                # the first rating on page 1 is the newest one
+                if not reviews:
+                    new_watermark.update(id=rating['id'], rDate=rating['rDate'])
+                reviews.append(parse_review(rating, professor_info))
+
+            # update remaining number of reviews
+            remaining_reviews = data.get('remaining', 0)
+            page += 1
+        else:
+            print(f'Error fetching page {page} for professorID {professorID}: {status_code}')
+            logging.info(f'Error fetching page {page} for professorID {professorID}: {status_code}')
+            return reviews, None
+
+    return reviews, new_watermark
+
+def carried_over_reviews(snapshot_file_path, professors, fetched_review_ids):
+    """
+    yields reviews collected by a previous run that were not fetched again this run.
+    reviews of professors that are no longer in professors.json are dropped, and professor columns are refreshed
+    """
+    professor_infos = {str(professor['node']['legacyId']): professor['node'] for professor in professors}
+
+    with open(snapshot_file_path, 'r', newline='', encoding='utf-8') as csvfile:
+        for review in csv.DictReader(csvfile):
+            professor_info = professor_infos.get(review['Professor ID'])
+            if professor_info is None or review['Review ID'] in fetched_review_ids:
+                continue
+
+            review.update(professor_columns(professor_info))
+            yield review
+
+def read_checkpoint(checkpoint_file_path, run_id):
+    """returns the checkpoint left by an unfinished attempt of this run, or None"""
+    if not os.path.exists(checkpoint_file_path):
+        return None
+
+    with open(checkpoint_file_path, 'r') as file:
+        checkpoint = json.load(file)
+
+    if checkpoint.get('run_id') != run_id:
+        return None
+    return checkpoint
+
+def load_checkpoint(checkpoint_file_path, professors_hash, incremental, run_id):
+    """returns the checkpoint of an unfinished attempt of this run over the same professors.json, or None"""
+    checkpoint = read_checkpoint(checkpoint_file_path, run_id)
+    if checkpoint is None or checkpoint['professors_hash'] != professors_hash or checkpoint['incremental'] != incremental:
+        return None
+    return checkpoint
+
+def fetch_in_order(executor, client, professors, watermarks, start, window):
+    """
+    submits professors to the executor at most `window` ahead of the one being consumed and yields their results in professor order.
+    unlike executor.map, finished professors cannot pile up in memory behind a slow one
+    """
+    pending = deque()
+    indices = iter(range(start, len(professors)))
+
+    def submit(index):
+        pending.append(executor.submit(fetch_professor_reviews, client, index, professors[index], watermarks[index]))
+
+    for index in itertools.islice(indices, window):
+        submit(index)
+
+    while pending:
+        result = pending.popleft().result()
+        next_index = next(indices, None)
+        if next_index is not None:
+            submit(next_index)
+        yield result
+
+def school_directory(school_id):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), SCHOOLS_DIRECTORY, str(school_id))
+
+def partition_file_path(school_id, run_id=None):
+    """reviews.csv partition of one school in a run, runs/<run id>/get_reviews/school_id=<school id>/reviews.csv"""
+    return os.path.join(stage_directory(COLLECTED, run_id), f'school_id={school_id}', 'reviews.csv')
+
+@contextmanager
+def school_lock(state_directory):
+    """blocks until no other process holds the lock of a school's state directory"""
+    with open(os.path.join(state_directory, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def discover_professors(client, school_id):
+    """
+    gets every professor at a school from the teacher search and writes them to the school's professors.json,
+    in the same shape as the get_professors GraphQL wrapper's output
+    """
+    edges = []
+    cursor = ''
+    while True:
+        status_code, data = client.search_professors(school_id, cursor, PROFESSORS_PAGE_SIZE)
+        if status_code != 200:
+            raise RuntimeError(f'ERROR: professor discovery for school {school_id} failed: {status_code}')
+
+        teachers = data['search']['teachers']
+        edges.extend(teachers['edges'])
+        print(f'Fetched {len(edges)} professors for school {school_id}')
+        logging.info(f'Fetched {len(edges)} professors for school {school_id}')
+
+        if not teachers['pageInfo']['hasNextPage']:
+            break
+        cursor = teachers['pageInfo']['endCursor']
+
+    professors_file_path = os.path.join(school_directory(school_id), PROFESSORS_FILE)
+    write_json({'search': {'teachers': {'edges': edges, 'pageInfo': teachers['pageInfo']}}}, professors_file_path)
+    return professors_file_path
+
+def collect_school(executor, client, school_id, max_workers=MAX_WORKERS, incremental=False, discover=True, run_id=None):
+    """
+    collects reviews for every professor at one school into its reviews.csv partition of the run and returns the partition's path.
+    discover=True gets the school's professors from the teacher search first, otherwise the previous professors.json is reused.
+    rows are streamed to reviews.csv.partial as each professor finishes, and a checkpoint lets a restarted run continue where it stopped
+    """
+    state_directory = school_directory(school_id)
+    os.makedirs(state_directory, exist_ok=True)
+    professors_file_path = os.path.join(state_directory, PROFESSORS_FILE)
+    reviews_file_path = partition_file_path(school_id, run_id)
+    os.makedirs(os.path.dirname(reviews_file_path), exist_ok=True)
+    partial_file_path = f'{reviews_file_path}.partial'
+    watermarks_file_path = os.path.join(state_directory, WATERMARKS_FILE)
+    snapshot_file_path = os.path.join(state_directory, SNAPSHOT_FILE)
+    checkpoint_file_path = os.path.join(state_directory, CHECKPOINT_FILE)
+    metrics = current_metrics()
+
+    # concurrent runs share the school's state (professors.json, watermarks, snapshot and checkpoint), one collects it at a time
+    with school_lock(state_directory):
+        # a retry resumes over the professors.json its checkpoint was taken from: discovering again would rewrite it
+        # (e.g. with new numRatings) and throw the checkpoint away
+        resuming = os.path.exists(partial_file_path) and read_checkpoint(checkpoint_file_path, run_id) is not None
+        if discover and not resuming:
+            with metrics.step('discover_professors'):
+                discover_professors(client, school_id)
+
+        with open(professors_file_path, 'r') as file:
+            data = json.load(file)
+            professors = data["search"]["teachers"]["edges"]
+        metrics.add(rows_in=len(professors))
+
+        # watermarks are only usable together with the snapshot holding the reviews they refer to
+        incremental = incremental and os.path.exists(snapshot_file_path)
+        professors_hash = file_hash(professors_file_path)
+        checkpoint = load_checkpoint(checkpoint_file_path, professors_hash, incremental, run_id)
+
+        if checkpoint is None or not os.path.exists(partial_file_path):
+            with open(partial_file_path, 'w', newline='', encoding='utf-8') as csvfile:
+                csv.DictWriter(csvfile, fieldnames=FIELDNAMES).writeheader()
+
+            checkpoint = {
+                'run_id': run_id,
+                'professors_hash': professors_hash,
+                'incremental': incremental,
+                'completed': 0,
+                'offset': os.path.getsize(partial_file_path),
+                'watermarks': load_watermarks(watermarks_file_path) if incremental else {}
+            }
+            write_json(checkpoint, checkpoint_file_path)
+        else:
+            print(f'Resuming school {school_id} from checkpoint at Professor #{checkpoint["completed"]}')
+            logging.info(f'Resuming school {school_id} from checkpoint at Professor #{checkpoint["completed"]}')
+
+        # drop rows written after the last checkpoint, they will be fetched again
+        os.truncate(partial_file_path, checkpoint['offset'])
+
+        # entries of professors that are not completed yet still hold the previous run's watermark
+        new_watermarks = checkpoint['watermarks']
+        watermarks = [new_watermarks.get(str(professor['node']['legacyId'])) for professor in professors]
+
+        fetched_review_ids = set()
+        if incremental:
+            with open(partial_file_path, 'r', newline='', encoding='utf-8') as csvfile:
+                fetched_review_ids.update(review['Review ID'] for review in csv.DictReader(csvfile))
+
+        # professors are fetched concurrently on the shared executor, while pages within a professor stay sequential.
+        # results are consumed in professor order, so the output matches the serial path exactly
+        with open(partial_file_path, 'a', newline='', encoding='utf-8') as csvfile, metrics.step('fetch_reviews'):
+            writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+            results = fetch_in_order(executor, client, professors, watermarks, checkpoint['completed'], max_workers * 2)
+
+            for index, (professor_reviews, watermark) in enumerate(results, start=checkpoint['completed']):
+                writer.writerows(professor_reviews)
+                metrics.add(rows_out=len(professor_reviews))
+                if incremental:
+                    fetched_review_ids.update(str(review['Review ID']) for review in professor_reviews)
+
+                # a professor that failed keeps its old watermark so the missed reviews are retried next run
+                if watermark is not None:
+                    new_watermarks[str(professors[index]['node']['legacyId'])] = watermark
+
+                if (index + 1) % CHECKPOINT_INTERVAL == 0 or index + 1 == len(professors):
+                    csvfile.flush()
+                    checkpoint.update(completed=index + 1, offset=os.fstat(csvfile.fileno()).st_size)
+                    write_json(checkpoint, checkpoint_file_path)
+
+            if incremental:
+                carried_over = 0
+                for review in carried_over_reviews(snapshot_file_path, professors, fetched_review_ids):
+                    writer.writerow(review)
+                    carried_over += 1
+                metrics.add(rows_out=carried_over)
+
+        os.replace(partial_file_path, reviews_file_path)
+
+        # keep a copy of the collected reviews and the watermarks for the next incremental run
+        link_atomically(reviews_file_path, snapshot_file_path)
+        write_json(new_watermarks, watermarks_file_path)
+        os.remove(checkpoint_file_path)
+
+    print(f'Reviews for school {school_id} have been successfully written to {reviews_file_path}')
+    logging.info(f'Reviews for school {school_id} have been successfully written to {reviews_file_path}')
+    return reviews_file_path
+
+def merge_partitions(partition_file_paths, reviews_file_path):
+    """concatenates the per-school partitions into one reviews.csv, keeping only the first header"""
+    with atomic_write(reviews_file_path) as temp_file_path, open(temp_file_path, 'wb') as output:
+        for index, partition_file_path in enumerate(partition_file_paths):
+            with open(partition_file_path, 'rb') as partition:
+                header = partition.readline()
+                if index == 0:
+                    output.write(header)
+                shutil.copyfileobj(partition, output)
+
+@instrumented('get_reviews')
+def get_reviews(school_ids=SCHOOL_IDS, max_workers=MAX_WORKERS, requests_per_second=REQUESTS_PER_SECOND, incremental=False,
+                offline=False, discover=True, shard=None, run_id=None):
+    """
+    discovers the professors of every school in school_ids and collects their reviews, one reviews.csv partition per school,
+    then concatenates the partitions into the run's reviews.csv (or the shard's reviews.csv, when collecting one shard).
+    the reviews.csv of an unsharded run is also published as pipeline/dags/reviews.csv.
+    schools are collected concurrently (SCHOOL_WORKERS at a time) over one client and one pool of MAX_WORKERS professor fetchers.
+    incremental=True only fetches reviews newer than the previous run's watermarks and carries the rest over from its snapshot.
+    offline=True replays every page from the response cache and never touches the network, reusing each school's professors.json
+    """
+    current_directory = os.path.dirname(os.path.abspath(__file__))
+    reviews_file_path = raw_reviews_file_path(run_id, shard)
+    os.makedirs(os.path.dirname(reviews_file_path), exist_ok=True)
+    discover = discover and not offline
+    metrics = current_metrics()
+
+    cache = None
+    if RESPONSE_CACHE_DIR is not None:
+        cache = ResponseCache(os.path.join(current_directory, RESPONSE_CACHE_DIR), RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES)
+    client = RatingsClient(pool_size=max_workers, requests_per_second=requests_per_second, cache=cache, offline=offline,
+                           timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+                ThreadPoolExecutor(max_workers=min(SCHOOL_WORKERS, len(school_ids))) as school_executor:
+            # every school runs in a copy of this context, so it records into this stage's metrics
+            futures = [
+                school_executor.submit(contextvars.copy_context().run, collect_school, executor, client, school_id, max_workers,
+                                       incremental, discover, run_id)
+                for school_id in school_ids
+            ]
+            partition_file_paths = [future.result() for future in futures]
+    finally:
+        client.close()
+        metrics.add(bytes_read=client.stats.bytes)
+        print(f'Fetch stats: {client.stats.summary()}')
+        logging.info(f'Fetch stats: {client.stats.summary()}')
+
+    with metrics.step('merge_partitions'):
+        merge_partitions(partition_file_paths, reviews_file_path)
+    metrics.wrote_file(reviews_file_path)
+    if shard is None:
+        publish_raw_reviews(run_id)
+
+    print(f'Reviews have been successfully written to {reviews_file_path}')
+    logging.info(f'Reviews have been successfully written to {reviews_file_path}')
 
 def main():
     get_reviews()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,352 @@
+import base64
+from collections import Counter
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+RATINGS_URL = 'https://www.ratemyprofessors.com/paginate/professors/ratings'
+
+# teacher search, as used by the get_professors GraphQL wrapper
+GRAPHQL_URL = 'https://www.ratemyprofessors.com/graphql'
+GRAPHQL_AUTHORIZATION = 'Basic dGVzdDp0ZXN0'
+
+TEACHER_SEARCH_QUERY = """
+query TeacherSearchPaginationQuery($count: Int!, $cursor: String, $query: TeacherSearchQuery!) {
+  search: newSearch {
+    teachers(query: $query, first: $count, after: $cursor) {
+      edges {
+        cursor
+        node {
+          id
+          legacyId
+          avgRating
+          numRatings
+          wouldTakeAgainPercent
+          avgDifficulty
+          department
+          school {
+            name
+            id
+          }
+          firstName
+          lastName
+        }
+      }
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      resultCount
+    }
+  }
+}
+"""
+
+# responses that mean the server is overloaded or throttling us: retried with backoff and slow down the rate limiter
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class RateLimiter:
+    """
+    spaces out requests so that each host receives at most `requests_per_second` requests.
+    the rate adapts to the server (additive increase, multiplicative decrease): it is halved on throttled or failed responses
+    and grows back towards `requests_per_second` while requests succeed
+    """
+
+    MIN_REQUESTS_PER_SECOND = 0.5
+    SLOW_DOWN_COOLDOWN = 1.0
+
+    def __init__(self, requests_per_second):
+        self.max_requests_per_second = requests_per_second
+        self.requests_per_second = requests_per_second
+        self._next_slot = {}
+        self._last_slow_down = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """blocks the calling thread until the next request slot for the url's host"""
+        if not self.requests_per_second:
+            return
+
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + 1 / self.requests_per_second
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def slow_down(self):
+        """halves the rate, at most once per cooldown so a burst of failures does not collapse it at once"""
+        if not self.max_requests_per_second:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_slow_down >= self.SLOW_DOWN_COOLDOWN:
+                self.requests_per_second = max(self.MIN_REQUESTS_PER_SECOND, self.requests_per_second / 2)
+                self._last_slow_down = now
+
+    def speed_up(self):
+        if not self.max_requests_per_second:
+            return
+
+        with self._lock:
+            self.requests_per_second = min(self.max_requests_per_second, self.requests_per_second + self.max_requests_per_second / 20)
+
+class FetchStats:
+    """thread-safe per-run counters for the ratings client"""
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.connection_errors = 0
+        self.cache_hits = 0
+        self.revalidated = 0
+        self.bytes = 0
+        self.status_codes = Counter()
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def record_request(self, response, latency):
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if response is None:
+                self.connection_errors += 1
+            else:
+                self.status_codes[response.status_code] += 1
+                self.bytes += len(response.content)
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def summary(self):
+        """counters plus latency percentiles in milliseconds"""
+        with self._lock:
+            latencies = sorted(self.latencies)
+
+            def percentile(p):
+                if not latencies:
+                    return None
+                return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 1)
+
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'connection_errors': self.connection_errors,
+                'cache_hits': self.cache_hits,
+                'revalidated': self.revalidated,
+                'bytes': self.bytes,
+                'status_codes': dict(self.status_codes),
+                'latency_p50_ms': percentile(50),
+                'latency_p90_ms': percentile(90),
+                'latency_p99_ms': percentile(99),
+            }
+
+class ResponseCache:
+    """
+    on-disk cache of paginator responses keyed by (tid, page).
+    entries younger than `ttl` seconds are served without a request, older ones are revalidated with their ETag/Last-Modified.
+    once the cache grows past `max_bytes`, the least recently used entries are evicted
+    """
+
+    def __init__(self, cache_dir, ttl, max_bytes):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # file name -> (size, last used), seeded from what previous runs left on disk
+        self._entries = {}
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                self._entries[entry.name] = (stat.st_size, stat.st_mtime)
+
+    def _file_name(self, tid, page):
+        return f'{tid}_{page}.json'
+
+    def get(self, tid, page):
+        """returns the cached entry for a page, or None"""
+        file_name = self._file_name(tid, page)
+        try:
+            with open(os.path.join(self.cache_dir, file_name), 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        with self._lock:
+            if file_name in self._entries:
+                self._entries[file_name] = (self._entries[file_name][0], time.time())
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def put(self, tid, page, payload, etag=None, last_modified=None):
+        entry = {'fetched_at': time.time(), 'etag': etag, 'last_modified': last_modified, 'payload': payload}
+        file_name = self._file_name(tid, page)
+        body = json.dumps(entry).encode('utf-8')
+
+        # write to a temporary file first so concurrent readers never see a partial entry
+        fd, temp_file_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(body)
+        os.replace(temp_file_path, os.path.join(self.cache_dir, file_name))
+
+        with self._lock:
+            self._entries[file_name] = (len(body), entry['fetched_at'])
+            self._evict()
+
+    def _evict(self):
+        total_bytes = sum(size for size, _ in self._entries.values())
+        if total_bytes <= self.max_bytes:
+            return
+
+        for file_name, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+            del self._entries[file_name]
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+
+class RatingsClient:
+    """
+    fetches pages from the RateMyProfessors ratings paginator and teacher search over a single pooled session.
+    safe to share between threads: connections are reused from the pool and every request goes through the rate limiter.
+    with a cache, fresh pages are served from disk, and offline=True replays the cache without touching the network.
+    timeouts, connection errors and RETRY_STATUS_CODES are retried up to `max_retries` times with exponential backoff and full jitter
+    """
+
+    def __init__(self, pool_size=1, requests_per_second=None, cache=None, offline=False,
+                 timeout=(5, 30), max_retries=5, backoff_base=0.5, backoff_max=30):
+        if offline and cache is None:
+            raise ValueError('offline mode requires a response cache')
+
+        self.cache = cache
+        self.offline = offline
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats = FetchStats()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.rate_limiter = RateLimiter(requests_per_second)
+
+    def fetch_page(self, tid, page, revalidate=False):
+        """
+        returns (status_code, json payload or None) for one page of a professor's ratings.
+        revalidate=True never serves a cached page without asking the server, even a fresh one (e.g. when the professor
+        is known to have new reviews), except in offline mode
+        """
+        entry = self.cache.get(tid, page) if self.cache is not None else None
+        if entry is not None and (self.offline or (self.cache.is_fresh(entry) and not revalidate)):
+            self.stats.increment('cache_hits')
+            return 200, entry['payload']
+        if self.offline:
+            raise FileNotFoundError(f'ERROR: no cached response for tid={tid}, page={page} (offline mode)')
+
+        # revalidate a stale entry instead of downloading it again
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        url = f'{RATINGS_URL}?tid={tid}&page={page}'
+        response = self._get(url, headers)
+
+        if response.status_code == 304 and entry is not None:
+            self.stats.increment('revalidated')
+            self.cache.put(tid, page, entry['payload'], entry['etag'], entry['last_modified'])
+            return 200, entry['payload']
+        if response.status_code != 200:
+            return response.status_code, None
+
+        payload = response.json()
+        if self.cache is not None:
+            self.cache.put(tid, page, payload, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return response.status_code, payload
+
+    def search_professors(self, school_id, cursor='', count=1000):
+        """
+        returns (status_code, json payload or None) for one page of the teacher search at a school.
+        school_id is the school's legacy id, e.g. 1147 for WashU. search pages are never cached
+        """
+        if self.offline:
+            raise FileNotFoundError(f'ERROR: professor discovery for school {school_id} needs the network (offline mode)')
+
+        school_node_id = base64.b64encode(f'School-{school_id}'.encode('utf-8')).decode('ascii')
+        body = {
+            'query': TEACHER_SEARCH_QUERY,
+            'variables': {
+                'count': count,
+                'cursor': cursor,
+                'query': {'text': '', 'schoolID': school_node_id, 'fallback': True, 'departmentID': ''},
+            },
+        }
+        response = self._request('POST', GRAPHQL_URL, {'Authorization': GRAPHQL_AUTHORIZATION}, json=body)
+
+        if response.status_code != 200:
+            return response.status_code, None
+        return response.status_code, response.json()['data']
+
+    def _get(self, url, headers):
+        return self._request('GET', url, headers)
+
+    def _request(self, method, url, headers, **kwargs):
+        """
+        request with retries. returns the first response that is not retryable,
+        and raises requests.HTTPError or the last connection error once retries are exhausted
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait(url)
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, error = None, e
+            self.stats.record_request(response, time.monotonic() - start)
+
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                self.rate_limiter.speed_up()
+                return response
+
+            self.rate_limiter.slow_down()
+            if attempt == self.max_retries:
+                break
+
+            self.stats.increment('retries')
+            time.sleep(self._backoff(attempt, response))
+
+        if response is None:
+            raise error
+        response.raise_for_status()
+
+    def _backoff(self, attempt, response):
+        """full-jitter exponential backoff, never shorter than the server's Retry-After"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(self.backoff_max, int(retry_after)))
+        return delay
+
+    def close(self):
+        self.session.close()
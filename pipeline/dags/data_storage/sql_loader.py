@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+import numpy as np
+import pandas as pd
+from data_storage.table_upload import UPLOAD_WORKERS, upload_tables
+from utils.reviews_io import atomic_write
+
+# primary key of every table loaded by store_data, in foreign-key order (parents before children)
+TABLE_KEYS = {
+    'SCHOOLS': ['SCHOOL_ID'],
+    'DEPARTMENTS': ['DEPARTMENT_ID'],
+    'PROFESSORS': ['PROFESSOR_ID'],
+    'CLASSES': ['CLASS_ID'],
+    'REVIEWS': ['REVIEW_ID'],
+    'CLASS_INSTRUCTORS': ['CLASS_ID', 'PROFESSOR_ID'],
+}
+
+DELETED_FLAG = '_DELETED'
+
+def row_hashes(dataframe):
+    """one 64-bit hash per row over every column, used to detect changed rows between loads"""
+    return pd.util.hash_pandas_object(dataframe, index=False).to_numpy()
+
+def load_state(state_dir, table_name):
+    """keys and row hashes of the rows loaded by the previous run, or None on the first run"""
+    state_file_path = os.path.join(state_dir, f'{table_name}.parquet')
+    if not os.path.exists(state_file_path):
+        return None
+    return pd.read_parquet(state_file_path)
+
+def save_state(state_dir, table_name, dataframe):
+    state = dataframe[TABLE_KEYS[table_name]].copy()
+    state['ROW_HASH'] = row_hashes(dataframe)
+    with atomic_write(os.path.join(state_dir, f'{table_name}.parquet')) as temp_file_path:
+        state.to_parquet(temp_file_path, index=False)
+
+def delta_rows(table_name, dataframe, previous_state):
+    """
+    rows to stage for a table: new and changed rows, plus the keys of rows that disappeared since the previous load
+    (flagged with _DELETED). without a previous state every row is staged
+    """
+    keys = TABLE_KEYS[table_name]
+    dataframe = dataframe.reset_index(drop=True)
+
+    if previous_state is None:
+        return dataframe.assign(**{DELETED_FLAG: False})
+
+    current_state = dataframe[keys].assign(ROW_HASH=row_hashes(dataframe))
+    compared = current_state.merge(previous_state, on=keys, how='outer', suffixes=('', '_PREVIOUS'), indicator=True)
+
+    changed = compared[(compared['_merge'] == 'left_only') | ((compared['_merge'] == 'both') & (compared['ROW_HASH'] != compared['ROW_HASH_PREVIOUS']))]
+    deleted = compared.loc[compared['_merge'] == 'right_only', keys]
+
+    upserts = dataframe.merge(changed[keys], on=keys, how='inner').assign(**{DELETED_FLAG: False})
+    # keys are downcast to the smallest type that holds them, so a deleted key may not fit the current type (e.g. 130 in int8)
+    deletes = deleted.astype({key: np.result_type(dataframe[key].dtype, previous_state[key].dtype) for key in keys})
+    deletes = deletes.assign(**{DELETED_FLAG: True})
+    return pd.concat([upserts, deletes], ignore_index=True)[list(dataframe.columns) + [DELETED_FLAG]]
+
+def stage_table_name(table_name):
+    return f'{table_name}_STAGE'
+
+def upsert_query(table_name, columns):
+    """MERGE of the staged new/changed rows into the target (Snowflake and DuckDB share this syntax)"""
+    keys = TABLE_KEYS[table_name]
+    on = ' AND '.join(f't.{key} = s.{key}' for key in keys)
+    values = [column for column in columns if column not in keys]
+
+    query = f'MERGE INTO {table_name} AS t USING {stage_table_name(table_name)} AS s ON {on}\n'
+    if values:
+        query += f'WHEN MATCHED AND NOT s.{DELETED_FLAG} THEN UPDATE SET {", ".join(f"{column} = s.{column}" for column in values)}\n'
+    query += f'WHEN NOT MATCHED AND NOT s.{DELETED_FLAG} THEN INSERT ({", ".join(columns)}) VALUES ({", ".join(f"s.{column}" for column in columns)})'
+    return query
+
+def delete_query(table_name):
+    keys = TABLE_KEYS[table_name]
+    on = ' AND '.join(f't.{key} = s.{key}' for key in keys)
+    return f'MERGE INTO {table_name} AS t USING {stage_table_name(table_name)} AS s ON {on}\nWHEN MATCHED AND s.{DELETED_FLAG} THEN DELETE'
+
+def incremental_load(cursor, dataframes, write_dataframe, state_dir, max_workers=UPLOAD_WORKERS):
+    """
+    loads only new, changed and deleted rows into existing tables.
+    every table's delta is first written to a temporary stage table, then all MERGEs run in a single transaction,
+    so readers switch from the old to the new data at once and never see empty or half-loaded tables.
+    upserts run parents first and deletes children first, so foreign keys hold at every step.
+    (Snowflake does not enforce foreign keys; DuckDB does, but rejects deleting a parent in the same transaction
+    as its children, so a DuckDB stand-in creates the tables with store_data.table_creation_queries(foreign_keys=False))
+
+    cursor is anything with execute(sql) on a session whose dialect supports MERGE (a Snowflake cursor, a DuckDB connection),
+    and write_dataframe(dataframe, table_name) appends a dataframe to an existing table in the same session.
+    stage tables have no foreign keys, so up to max_workers of them are written at once
+    """
+    tables = [table_name for table_name in TABLE_KEYS if table_name in dataframes]
+    deltas = {}
+
+    for table_name in tables:
+        deltas[table_name] = delta_rows(table_name, dataframes[table_name], load_state(state_dir, table_name))
+        cursor.execute(f'CREATE OR REPLACE TEMPORARY TABLE {stage_table_name(table_name)} AS '
+                       f'SELECT *, FALSE AS {DELETED_FLAG} FROM {table_name} LIMIT 0')
+
+        deleted = int(deltas[table_name][DELETED_FLAG].sum())
+        logging.info(f"Table '{table_name}': staged {len(deltas[table_name]) - deleted} new/changed and {deleted} deleted rows")
+
+    staged = {stage_table_name(table_name): deltas[table_name] for table_name in tables if len(deltas[table_name]) > 0}
+    upload_tables(staged, write_dataframe, max_workers, dependencies={})
+
+    cursor.execute('BEGIN')
+    try:
+        for table_name in tables:
+            cursor.execute(upsert_query(table_name, list(dataframes[table_name].columns)))
+        for table_name in reversed(tables):
+            cursor.execute(delete_query(table_name))
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+
+    for table_name in tables:
+        cursor.execute(f'DROP TABLE IF EXISTS {stage_table_name(table_name)}')
+
+    # only remember what was loaded once the transaction is committed
+    for table_name in tables:
+        save_state(state_dir, table_name, dataframes[table_name])
+    logging.info('Incremental load committed')
+
+def duckdb_writer(conn):
+    """write_dataframe for a local DuckDB stand-in of the warehouse (a DuckDB connection is not thread-safe, so writes are serialized)"""
+    lock = threading.Lock()
+
+    def write_dataframe(dataframe, table_name):
+        with lock:
+            conn.register('incoming_dataframe', dataframe)
+            try:
+                conn.execute(f'INSERT INTO {table_name} BY NAME SELECT * FROM incoming_dataframe')
+            finally:
+                conn.unregister('incoming_dataframe')
+    return write_dataframe
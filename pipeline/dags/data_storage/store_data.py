@@ -1,183 +1,216 @@
-import pandas as pd
-import os
 import logging
-from snowflake.connector import connect
+import os
+import re
+import pandas as pd
 from snowflake.connector.pandas_tools import write_pandas
-from airflow.hooks.base import BaseHook
-from snowflake.connector import connect
-
-def organize_data():
-    """creates and loads pandas dataframes using reviews.csv"""
-
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    reviews_file_path = os.path.join(current_directory, '../reviews.csv')
-    data = pd.read_csv(reviews_file_path)
-    reviews_df = data[
-        [
-            'REVIEW_ID',
-            'CLASS_ID',
-            'PROFESSOR_ID',
-            'QUALITY',
-            'DIFFICULTY',
-            'REVIEW',
-            'DATE',
-            'WOULD_TAKE_AGAIN',
-            'GRADE',
-            'ATTENDANCE',
-            'TEXTBOOK_USAGE',
-            'SENTIMENT_SCORE',
-            'THUMBS_UP',
-            'THUMBS_DOWN'
-        ]
-    ]
-
-    classes_df = data[
-        [
-            'CLASS_ID',
-            'SCHOOL_ID',
-            'DEPARTMENT_ID',
-            'COURSE_CODE'
-        ]
-    ].drop_duplicates()
-
-    professors_df = data[
-        [
-            'PROFESSOR_ID',
-            'PROFESSOR_NAME',
-            'OVERALL_QUALITY',
-            'OVERALL_DIFFICULTY'
-        ]
-    ].drop_duplicates()
-
-    schools_df = data[
-        [
-            'SCHOOL_ID',
-            'SCHOOL_NAME'
-        ]
-    ].drop_duplicates()
-
-    departments_df = data[
-        [
-            'DEPARTMENT_ID',
-            'DEPARTMENT_NAME'
-        ]
-    ].drop_duplicates()
-
-    class_instructors_df = data[
-        [
-            'CLASS_ID',
-            'PROFESSOR_ID'
-        ]
-    ].drop_duplicates()
-
-    return {
-        'SCHOOLS': schools_df,
-        'DEPARTMENTS': departments_df,
-        'PROFESSORS': professors_df,
-        'CLASSES': classes_df,
-        'REVIEWS': reviews_df,
-        'CLASS_INSTRUCTORS': class_instructors_df
-    }
-
-def upload_to_snowflake(dataframes):
-    """creates tables and uploads data to Snowflake"""
-    
-    # get snowflake connection from airflow
-    snowflake_conn_id = 'snowflake_default'
-    conn_details = BaseHook.get_connection(snowflake_conn_id)
-
-    conn = connect(
-        user=conn_details.login,
-        password=conn_details.password,
-        account=conn_details.extra_dejson.get('account'),
-        warehouse=conn_details.extra_dejson.get('warehouse'),
-        database=conn_details.extra_dejson.get('database'),
-        schema=conn_details.extra_dejson.get('schema')
-    )
+from data_storage.sql_loader import TABLE_KEYS, incremental_load, save_state
+from data_storage.table_upload import UPLOAD_CHUNK_SIZE, UPLOAD_COMPRESSION, UPLOAD_WORKERS, upload_tables
+from utils.instrumentation import current_metrics, instrumented, peak_rss_megabytes
+from utils.manifests import SKIP_UNCHANGED_STAGES, file_hash
+from utils.reviews_io import ANALYZED, atomic_write, publish_reviews, read_reviews, reviews_file_path
+from utils.warehouse import connect_warehouse
 
-    try:
-        # create tables & upload data to snowflake
-        table_creation_queries = {
-            "schools": """
-                CREATE OR REPLACE TABLE schools (
-                    school_id INTEGER PRIMARY KEY,
-                    school_name VARCHAR NOT NULL
-                )
-            """,
-            "departments": """
-                CREATE OR REPLACE TABLE departments (
-                    department_id INTEGER PRIMARY KEY,
-                    department_name VARCHAR NOT NULL
-                )
-            """,
-            "professors": """
-                CREATE OR REPLACE TABLE professors (
-                        professor_id INTEGER PRIMARY KEY,
-                        professor_name VARCHAR NOT NULL,
-                        overall_quality FLOAT NOT NULL,
-                        overall_difficulty FLOAT NOT NULL
-                )
-            """,
-            "classes": """
-                CREATE OR REPLACE TABLE classes (
-                    school_id INTEGER,
-                    department_id INTEGER,
-                    class_id INTEGER PRIMARY KEY,
-                    course_code VARCHAR NOT NULL,
-                    FOREIGN KEY (school_id) REFERENCES schools(school_id),
-                    FOREIGN KEY (department_id) REFERENCES departments(department_id)
-                )
-            """,
-            "reviews": """
-                CREATE OR REPLACE TABLE reviews (
-                    review_id INTEGER PRIMARY KEY,
-                    class_id INTEGER,
-                    professor_id INTEGER,
-                    quality FLOAT NOT NULL,
-                    difficulty FLOAT NOT NULL,
-                    review TEXT,
-                    date DATE NOT NULL,
-                    would_take_again BOOLEAN,
-                    grade VARCHAR,
-                    attendance VARCHAR,
-                    textbook_usage BOOLEAN,
-                    thumbs_up INTEGER,
-                    thumbs_down INTEGER,
-                    sentiment_score FLOAT,
-                    FOREIGN KEY (class_id) REFERENCES classes(class_id),
-                    FOREIGN KEY (professor_id) REFERENCES professors(professor_id)
-                )
-            """,
-            "class_instructors": """
-                CREATE OR REPLACE TABLE class_instructors (
-                    class_id INTEGER NOT NULL,
-                    professor_id INTEGER NOT NULL,
-                    FOREIGN KEY (class_id) REFERENCES classes(class_id),
-                    FOREIGN KEY (professor_id) REFERENCES professors(professor_id),
-                    PRIMARY KEY (class_id, professor_id)
-                )
-            """
-        }
+# 'incremental': MERGE only new, changed and deleted rows into the existing tables
+# 'full': recreate every table and reload all rows
+LOAD_MODE = 'incremental'
+
+# keys and row hashes of the last load, used to compute the next incremental delta
+LOAD_STATE_DIRECTORY = 'load_state'
+
+# hash of the reviews file of the last committed load, in LOAD_STATE_DIRECTORY
+LOADED_REVIEWS_FILE = 'loaded_reviews.sha256'
+
+# columns of each table loaded to Snowflake
+TABLE_COLUMNS = {
+    'SCHOOLS': ['SCHOOL_ID', 'SCHOOL_NAME'],
+    'DEPARTMENTS': ['DEPARTMENT_ID', 'DEPARTMENT_NAME'],
+    'PROFESSORS': ['PROFESSOR_ID', 'PROFESSOR_NAME', 'OVERALL_QUALITY', 'OVERALL_DIFFICULTY'],
+    'CLASSES': ['CLASS_ID', 'SCHOOL_ID', 'DEPARTMENT_ID', 'COURSE_CODE'],
+    'REVIEWS': [
+        'REVIEW_ID',
+        'CLASS_ID',
+        'PROFESSOR_ID',
+        'QUALITY',
+        'DIFFICULTY',
+        'REVIEW',
+        'DATE',
+        'WOULD_TAKE_AGAIN',
+        'GRADE',
+        'ATTENDANCE',
+        'TEXTBOOK_USAGE',
+        'SENTIMENT_SCORE',
+        'THUMBS_UP',
+        'THUMBS_DOWN'
+    ],
+    'CLASS_INSTRUCTORS': ['CLASS_ID', 'PROFESSOR_ID'],
+}
+
+# every column of the analyzed reviews that a table needs
+REVIEW_COLUMNS = list(dict.fromkeys(column for table_columns in TABLE_COLUMNS.values() for column in table_columns))
+
+# repeated strings read as categoricals: one copy per distinct value instead of one per review
+CATEGORICAL_COLUMNS = ['SCHOOL_NAME', 'DEPARTMENT_NAME', 'PROFESSOR_NAME', 'COURSE_CODE', 'GRADE', 'ATTENDANCE']
+
+# surrogate keys, downcast to the smallest integer type that holds them
+KEY_COLUMNS = ['SCHOOL_ID', 'DEPARTMENT_ID', 'PROFESSOR_ID', 'CLASS_ID']
+
+def megabytes(dataframe):
+    return dataframe.memory_usage(index=False, deep=True).sum() / 2 ** 20
+
+def organize_data(run_id=None):
+    """splits the run's analyzed reviews into the tables loaded to Snowflake (see split_tables)"""
+    with current_metrics().step('read'):
+        data = read_reviews(ANALYZED, columns=REVIEW_COLUMNS, categories=CATEGORICAL_COLUMNS, run_id=run_id)
+    dataframes = split_tables(data)
+
+    logging.info(f'Reviews read: {len(data)} rows, {megabytes(data):.1f} MB in memory, peak RSS {peak_rss_megabytes():.0f} MB')
+    for table_name, dataframe in dataframes.items():
+        logging.info(f"Table '{table_name}': {len(dataframe)} rows, {megabytes(dataframe):.1f} MB")
+
+    return dataframes
+
+def split_tables(data):
+    """
+    splits analyzed reviews (with at least REVIEW_COLUMNS) into the tables loaded to Snowflake.
+    dimension tables keep the first row of every key, deduplicated on integer keys instead of strings,
+    and the reviews table reuses the columns of data, so the review text is never copied.
+    the dashboard's DuckDB backend builds its local tables with it too
+    """
+    metrics = current_metrics()
+    for column in KEY_COLUMNS:
+        data[column] = pd.to_numeric(data[column], downcast='integer')
 
+    dataframes = {}
+    for table_name, table_columns in TABLE_COLUMNS.items():
+        with metrics.step(f'build_{table_name.lower()}'):
+            if table_name == 'REVIEWS':
+                # one row per review already; built from the existing columns without copying them
+                dataframes[table_name] = pd.DataFrame({column: data[column] for column in table_columns}, copy=False)
+            else:
+                first_rows = ~data.duplicated(subset=TABLE_KEYS[table_name]).to_numpy()
+                dataframes[table_name] = data.loc[first_rows, table_columns].reset_index(drop=True)
+    return dataframes
+
+TABLE_CREATION_QUERIES = {
+    "schools": """
+        CREATE OR REPLACE TABLE schools (
+            school_id INTEGER PRIMARY KEY,
+            school_name VARCHAR NOT NULL
+        )
+    """,
+    "departments": """
+        CREATE OR REPLACE TABLE departments (
+            department_id INTEGER PRIMARY KEY,
+            department_name VARCHAR NOT NULL
+        )
+    """,
+    "professors": """
+        CREATE OR REPLACE TABLE professors (
+                professor_id INTEGER PRIMARY KEY,
+                professor_name VARCHAR NOT NULL,
+                overall_quality FLOAT NOT NULL,
+                overall_difficulty FLOAT NOT NULL
+        )
+    """,
+    "classes": """
+        CREATE OR REPLACE TABLE classes (
+            school_id INTEGER,
+            department_id INTEGER,
+            class_id INTEGER PRIMARY KEY,
+            course_code VARCHAR NOT NULL,
+            FOREIGN KEY (school_id) REFERENCES schools(school_id),
+            FOREIGN KEY (department_id) REFERENCES departments(department_id)
+        )
+    """,
+    "reviews": """
+        CREATE OR REPLACE TABLE reviews (
+            review_id INTEGER PRIMARY KEY,
+            class_id INTEGER,
+            professor_id INTEGER,
+            quality FLOAT NOT NULL,
+            difficulty FLOAT NOT NULL,
+            review TEXT,
+            date DATE NOT NULL,
+            would_take_again BOOLEAN,
+            grade VARCHAR,
+            attendance VARCHAR,
+            textbook_usage BOOLEAN,
+            thumbs_up INTEGER,
+            thumbs_down INTEGER,
+            sentiment_score FLOAT,
+            FOREIGN KEY (class_id) REFERENCES classes(class_id),
+            FOREIGN KEY (professor_id) REFERENCES professors(professor_id)
+        )
+    """,
+    "class_instructors": """
+        CREATE OR REPLACE TABLE class_instructors (
+            class_id INTEGER NOT NULL,
+            professor_id INTEGER NOT NULL,
+            FOREIGN KEY (class_id) REFERENCES classes(class_id),
+            FOREIGN KEY (professor_id) REFERENCES professors(professor_id),
+            PRIMARY KEY (class_id, professor_id)
+        )
+    """
+}
+
+# a FOREIGN KEY clause of TABLE_CREATION_QUERIES, with the comma before it
+FOREIGN_KEY_CLAUSE = re.compile(r',\s*FOREIGN KEY \([^)]*\) REFERENCES \w+\([^)]*\)')
+
+def table_creation_queries(foreign_keys=True):
+    """
+    TABLE_CREATION_QUERIES, optionally without their FOREIGN KEY clauses. DuckDB enforces foreign keys and rejects deleting
+    a parent in the same transaction as its children, so a local DuckDB stand-in of the warehouse creates the tables without them
+    """
+    if foreign_keys:
+        return dict(TABLE_CREATION_QUERIES)
+    return {table: FOREIGN_KEY_CLAUSE.sub('', query) for table, query in TABLE_CREATION_QUERIES.items()}
+
+def snowflake_writer(conn, chunk_size=UPLOAD_CHUNK_SIZE, compression=UPLOAD_COMPRESSION):
+    """write_dataframe for upload_tables/incremental_load. snowflake connections can be shared between threads"""
+    def write_dataframe(dataframe, table_name):
+        write_pandas(conn, dataframe, table_name, chunk_size=chunk_size, compression=compression)
+    return write_dataframe
+
+def upload_to_snowflake(dataframes, load_mode=LOAD_MODE, max_workers=UPLOAD_WORKERS, chunk_size=UPLOAD_CHUNK_SIZE, compression=UPLOAD_COMPRESSION):
+    """
+    creates tables and uploads data to Snowflake.
+    load_mode='full' recreates every table and reloads all rows, load_mode='incremental' creates missing tables
+    and MERGEs only new, changed and deleted rows in one transaction (see sql_loader.incremental_load)
+    """
+    conn, settings = connect_warehouse()
+    state_dir = load_state_directory()
+
+    try:
         with conn.cursor() as cursor:
             # create & use warehouse, db, schema if not exists
-            cursor.execute(f'CREATE WAREHOUSE IF NOT EXISTS {conn_details.extra_dejson.get("warehouse")}')
-            cursor.execute(f'ALTER WAREHOUSE {conn_details.extra_dejson.get("warehouse")} SET WAREHOUSE_SIZE=XSmall')
-            cursor.execute(f'USE WAREHOUSE {conn_details.extra_dejson.get("warehouse")}')
-            cursor.execute(f'CREATE DATABASE IF NOT EXISTS {conn_details.extra_dejson.get("database")}')
-            cursor.execute(f'USE DATABASE {conn_details.extra_dejson.get("database")}')
-            cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {conn_details.extra_dejson.get("schema")}')
-            cursor.execute(f'USE SCHEMA {conn_details.extra_dejson.get("schema")}')
+            cursor.execute(f'CREATE WAREHOUSE IF NOT EXISTS {settings.get("warehouse")}')
+            cursor.execute(f'ALTER WAREHOUSE {settings.get("warehouse")} SET WAREHOUSE_SIZE=XSmall')
+            cursor.execute(f'USE WAREHOUSE {settings.get("warehouse")}')
+            cursor.execute(f'CREATE DATABASE IF NOT EXISTS {settings.get("database")}')
+            cursor.execute(f'USE DATABASE {settings.get("database")}')
+            cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {settings.get("schema")}')
+            cursor.execute(f'USE SCHEMA {settings.get("schema")}')
+
+            if load_mode == 'incremental':
+                # create tables that do not exist yet, existing tables keep their data
+                for table, query in TABLE_CREATION_QUERIES.items():
+                    cursor.execute(query.replace('CREATE OR REPLACE TABLE', 'CREATE TABLE IF NOT EXISTS'))
+
+                incremental_load(cursor, dataframes, snowflake_writer(conn, chunk_size, compression), state_dir, max_workers)
+                return
 
             # create tables
-            for table, query in table_creation_queries.items():
+            for table, query in TABLE_CREATION_QUERIES.items():
                 cursor.execute(query)
                 logging.info(f"Table '{table}' successfully created")
 
-            # upload data
+            # upload data, independent tables in parallel
+            upload_stats = upload_tables(dataframes, snowflake_writer(conn, chunk_size, compression), max_workers)
+            logging.info(f'All tables uploaded to Snowflake: {upload_stats}')
+
+            # the next incremental load diffs against what was just loaded
             for table_name, dataframe in dataframes.items():
-                write_pandas(conn, dataframe, table_name)
-                logging.info(f"Table '{table_name}' successfully uploaded to Snowflake")
+                save_state(state_dir, table_name, dataframe)
 
     except Exception as e:
         logging.error("ERROR:", e)
@@ -186,9 +219,49 @@ def upload_to_snowflake(dataframes):
     finally:
         conn.close()
 
-def store_data():
-    dataframes = organize_data()
-    upload_to_snowflake(dataframes)
+def load_state_directory():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), LOAD_STATE_DIRECTORY)
+
+def loaded_reviews_hash(state_dir):
+    """hash of the reviews file of the last committed load, or None before the first one"""
+    file_path = os.path.join(state_dir, LOADED_REVIEWS_FILE)
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, 'r') as file:
+        return file.read().strip()
+
+def save_loaded_reviews_hash(state_dir, digest):
+    with atomic_write(os.path.join(state_dir, LOADED_REVIEWS_FILE)) as temp_file_path, open(temp_file_path, 'w') as file:
+        file.write(digest)
+
+def load_data(load_mode=LOAD_MODE, run_id=None):
+    """
+    loads the run's analyzed reviews to Snowflake. an incremental load is skipped when the last committed load was this exact
+    reviews file, so the tables already hold it; a full load, or a backfill of an older run, always runs
+    """
+    metrics = current_metrics()
+    state_dir = load_state_directory()
+    with metrics.step('hash_inputs'):
+        reviews_hash = file_hash(reviews_file_path(ANALYZED, run_id))
+    if SKIP_UNCHANGED_STAGES and load_mode == 'incremental' and loaded_reviews_hash(state_dir) == reviews_hash:
+        logging.info("Stage 'store_data' skipped: the last committed load was this exact reviews file")
+        metrics.status = 'skipped'
+        return
+
+    with metrics.step('organize'):
+        dataframes = organize_data(run_id)
+    metrics.add(rows_out=sum(len(dataframe) for dataframe in dataframes.values()))
+
+    with metrics.step('upload'):
+        upload_to_snowflake(dataframes, load_mode)
+    save_loaded_reviews_hash(state_dir, reviews_hash)
+
+@instrumented('store_data')
+def store_data(load_mode=LOAD_MODE, run_id=None):
+    """loads the run's analyzed reviews, then publishes them as the latest reviews"""
+    load_data(load_mode, run_id)
+    with current_metrics().step('publish'):
+        publish_reviews(run_id)
 
 if __name__ == "__main__":
     store_data()
\ No newline at end of file
@@ -0,0 +1,63 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# tables each table references through a foreign key, it is only uploaded once those are loaded
+TABLE_DEPENDENCIES = {
+    'SCHOOLS': [],
+    'DEPARTMENTS': [],
+    'PROFESSORS': [],
+    'CLASSES': ['SCHOOLS', 'DEPARTMENTS'],
+    'REVIEWS': ['CLASSES', 'PROFESSORS'],
+    'CLASS_INSTRUCTORS': ['CLASSES', 'PROFESSORS'],
+}
+
+# tables uploaded at the same time
+UPLOAD_WORKERS = 4
+
+# rows per file staged by write_pandas
+UPLOAD_CHUNK_SIZE = 100000
+
+# compression of the staged files: 'gzip' (smaller uploads) or 'snappy' (faster to compress)
+UPLOAD_COMPRESSION = 'gzip'
+
+def upload_table(write_dataframe, dataframe, table_name):
+    """uploads one table and returns its rows, in-memory bytes and seconds"""
+    start = time.perf_counter()
+    write_dataframe(dataframe, table_name)
+    stats = {
+        'rows': len(dataframe),
+        'bytes': int(dataframe.memory_usage(index=False, deep=True).sum()),
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+    logging.info(f"Table '{table_name}' uploaded: {stats['rows']} rows, {stats['bytes']} bytes in {stats['seconds']}s")
+    return stats
+
+def upload_tables(dataframes, write_dataframe, max_workers=UPLOAD_WORKERS, dependencies=TABLE_DEPENDENCIES):
+    """
+    uploads dataframes concurrently with write_dataframe(dataframe, table_name).
+    every table starts as soon as the tables it depends on are loaded, largest first, so a big table like REVIEWS
+    runs alongside the small ones instead of holding them up. returns {table_name: upload stats}
+    """
+    pending = dict(dataframes)
+    loaded = set()
+    running = {}
+    stats = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            ready = [table_name for table_name in pending
+                     if all(parent in loaded or parent not in dataframes for parent in dependencies.get(table_name, []))]
+            for table_name in sorted(ready, key=lambda table_name: len(pending[table_name]), reverse=True):
+                running[executor.submit(upload_table, write_dataframe, pending.pop(table_name), table_name)] = table_name
+
+            if not running:
+                raise ValueError(f'ERROR: circular table dependencies between {sorted(pending)}')
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table_name = running.pop(future)
+                stats[table_name] = future.result()
+                loaded.add(table_name)
+
+    return stats
@@ -0,0 +1,77 @@
+import logging
+from data_transformation.transform_data import FACT_REVIEW, qualified_name
+from utils.instrumentation import current_metrics, instrumented
+from utils.warehouse import connect_warehouse
+
+# rollup tables read by the dashboard instead of scanning fact_review
+ROLLUP_DEPARTMENT_MONTH = 'rollup_department_month'
+ROLLUP_CLASS_MONTH = 'rollup_class_month'
+ROLLUP_PROFESSOR_MONTH = 'rollup_professor_month'
+ROLLUP_CLASS_PROFESSOR = 'rollup_class_professor'
+ROLLUP_CLASS_GRADE = 'rollup_class_grade'
+
+# one row per published load, the dashboard drops its cached results when a new one appears
+PIPELINE_LOADS = 'pipeline_loads'
+
+# grain (group by columns) of every rollup table
+ROLLUPS = {
+    ROLLUP_DEPARTMENT_MONTH: ['DEPARTMENT_ID', 'MONTH'],
+    ROLLUP_CLASS_MONTH: ['DEPARTMENT_ID', 'CLASS_ID', 'MONTH'],
+    ROLLUP_PROFESSOR_MONTH: ['DEPARTMENT_ID', 'PROFESSOR_ID', 'MONTH'],
+    ROLLUP_CLASS_PROFESSOR: ['CLASS_ID', 'PROFESSOR_ID'],
+    ROLLUP_CLASS_GRADE: ['CLASS_ID', 'GRADE'],
+}
+
+# grain columns that are not fact_review columns
+GRAIN_EXPRESSIONS = {
+    'MONTH': "DATE_TRUNC('month', DATE)",
+}
+
+# counts and sums, so averages can be re-aggregated exactly at any coarser grain: AVG(x) = SUM(x_SUM) / SUM(x_COUNT)
+MEASURES = {
+    'REVIEW_COUNT': 'COUNT(*)',
+    'QUALITY_SUM': 'SUM(QUALITY)',
+    'QUALITY_COUNT': 'COUNT(QUALITY)',
+    'DIFFICULTY_SUM': 'SUM(DIFFICULTY)',
+    'DIFFICULTY_COUNT': 'COUNT(DIFFICULTY)',
+    'SENTIMENT_SUM': 'SUM(SENTIMENT_SCORE)',
+    'SENTIMENT_COUNT': 'COUNT(SENTIMENT_SCORE)',
+}
+
+def rollup_query(rollup_name, database=None, schema=None):
+    grain = [GRAIN_EXPRESSIONS.get(column, column) for column in ROLLUPS[rollup_name]]
+    columns = [f'{expression} AS {column}' for column, expression in zip(ROLLUPS[rollup_name], grain)]
+    columns += [f'{expression} AS {measure}' for measure, expression in MEASURES.items()]
+    return (
+        f'CREATE OR REPLACE TABLE {qualified_name(rollup_name, database, schema)} AS '
+        f'SELECT {", ".join(columns)} FROM {qualified_name(FACT_REVIEW, database, schema)} GROUP BY {", ".join(grain)}'
+    )
+
+def build_rollups(cursor, database=None, schema=None):
+    """
+    rebuilds every rollup table from fact_review.
+    cursor is anything with execute(sql) (a Snowflake cursor, a DuckDB connection)
+    """
+    for rollup_name in ROLLUPS:
+        with current_metrics().step(rollup_name):
+            cursor.execute(rollup_query(rollup_name, database, schema))
+
+def publish_load(cursor, database=None, schema=None):
+    """records that a new load is complete, once every rollup table is rebuilt"""
+    pipeline_loads = qualified_name(PIPELINE_LOADS, database, schema)
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS {pipeline_loads} (LOADED_AT TIMESTAMP NOT NULL)')
+    cursor.execute(f'INSERT INTO {pipeline_loads} (LOADED_AT) SELECT CURRENT_TIMESTAMP')
+    logging.info('New load published to the dashboard')
+
+@instrumented('summarize_data')
+def summarize_data():
+    conn, settings = connect_warehouse()
+    database = settings.get('database')
+    schema = settings.get('schema')
+
+    try:
+        with conn.cursor() as cursor:
+            build_rollups(cursor, database, schema)
+            publish_load(cursor, database, schema)
+    finally:
+        conn.close()
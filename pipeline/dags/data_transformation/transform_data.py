@@ -0,0 +1,128 @@
+from utils.instrumentation import current_metrics, instrumented
+from utils.warehouse import connect_warehouse
+
+# fact and dimension tables
+FACT_REVIEW = 'fact_review'
+DIM_CLASS = 'dim_class'
+DIM_PROFESSOR = 'dim_professor'
+DIM_SCHOOL = 'dim_school'
+DIM_DEPARTMENT = 'dim_department'
+
+# clustering key of fact_review, the columns dashboards filter on (None = no clustering key, e.g. for local stand-ins)
+FACT_REVIEW_CLUSTER_BY = ['DATE', 'DEPARTMENT_ID']
+
+# every materialized table: its key, its columns (name -> expression over the source) and the source it is selected from.
+# {name} placeholders are the normalized tables written by store_data
+MATERIALIZED_TABLES = {
+    FACT_REVIEW: {
+        'key': 'REVIEW_ID',
+        'columns': {
+            'REVIEW_ID': 'r.REVIEW_ID',
+            'CLASS_ID': 'r.CLASS_ID',
+            'PROFESSOR_ID': 'r.PROFESSOR_ID',
+            'DEPARTMENT_ID': 'c.DEPARTMENT_ID',
+            'SCHOOL_ID': 'c.SCHOOL_ID',
+            'QUALITY': 'r.QUALITY',
+            'DIFFICULTY': 'r.DIFFICULTY',
+            'REVIEW': 'r.REVIEW',
+            'DATE': 'r.DATE',
+            'WOULD_TAKE_AGAIN': 'r.WOULD_TAKE_AGAIN',
+            'GRADE': 'r.GRADE',
+            'ATTENDANCE': 'r.ATTENDANCE',
+            'TEXTBOOK_USAGE': 'r.TEXTBOOK_USAGE',
+            'NET_THUMBS_UP': '(r.THUMBS_UP - r.THUMBS_DOWN)',
+            'SENTIMENT_SCORE': 'r.SENTIMENT_SCORE',
+        },
+        'source': '{reviews} AS r JOIN {classes} AS c ON c.CLASS_ID = r.CLASS_ID',
+    },
+    DIM_CLASS: {
+        'key': 'CLASS_ID',
+        'columns': {'CLASS_ID': 'CLASS_ID', 'COURSE_CODE': 'COURSE_CODE'},
+        'source': '{classes}',
+    },
+    DIM_PROFESSOR: {
+        'key': 'PROFESSOR_ID',
+        'columns': {'PROFESSOR_ID': 'PROFESSOR_ID', 'PROFESSOR_NAME': 'PROFESSOR_NAME'},
+        'source': '{professors}',
+    },
+    DIM_SCHOOL: {
+        'key': 'SCHOOL_ID',
+        'columns': {'SCHOOL_ID': 'SCHOOL_ID', 'SCHOOL_NAME': 'SCHOOL_NAME'},
+        'source': '{schools}',
+    },
+    DIM_DEPARTMENT: {
+        'key': 'DEPARTMENT_ID',
+        'columns': {'DEPARTMENT_ID': 'DEPARTMENT_ID', 'DEPARTMENT_NAME': 'DEPARTMENT_NAME'},
+        'source': '{departments}',
+    },
+}
+
+def qualified_name(table_name, database=None, schema=None):
+    return '.'.join(part for part in (database, schema, table_name) if part)
+
+def source_query(table, database=None, schema=None):
+    normalized_tables = {name: qualified_name(name, database, schema) for name in ('reviews', 'classes', 'professors', 'schools', 'departments')}
+    columns = ', '.join(f'{expression} AS {column}' for column, expression in table['columns'].items())
+    return f"SELECT {columns} FROM {table['source'].format(**normalized_tables)}"
+
+def materialization_queries(table_name, database=None, schema=None, cluster_by=None):
+    """
+    (setup, refresh) queries for one table. setup creates the table from its source query if it does not exist yet;
+    refresh MERGEs new and changed rows by key (unchanged rows are not rewritten) and deletes rows whose key left the source
+    """
+    table = MATERIALIZED_TABLES[table_name]
+    target = qualified_name(table_name, database, schema)
+    source = source_query(table, database, schema)
+    key = table['key']
+    columns = list(table['columns'])
+    values = [column for column in columns if column != key]
+
+    setup = [f'CREATE TABLE IF NOT EXISTS {target} AS {source} LIMIT 0']
+    if cluster_by:
+        setup.append(f'ALTER TABLE {target} CLUSTER BY ({", ".join(cluster_by)})')
+
+    changed = ' OR '.join(f't.{column} IS DISTINCT FROM s.{column}' for column in values)
+    refresh = [
+        f'MERGE INTO {target} AS t USING ({source}) AS s ON t.{key} = s.{key}\n'
+        f'WHEN MATCHED AND ({changed}) THEN UPDATE SET {", ".join(f"{column} = s.{column}" for column in values)}\n'
+        f'WHEN NOT MATCHED THEN INSERT ({", ".join(columns)}) VALUES ({", ".join(f"s.{column}" for column in columns)})',
+        f'DELETE FROM {target} WHERE {key} NOT IN (SELECT {key} FROM ({source}) AS s)',
+    ]
+    return setup, refresh
+
+def materialize(cursor, database=None, schema=None, cluster_by=FACT_REVIEW_CLUSTER_BY):
+    """
+    incrementally refreshes fact_review and the dimension tables from the normalized tables.
+    all refreshes run in a single transaction, so dashboards never see a fact table that is out of step with its dimensions.
+    cursor is anything with execute(sql) whose dialect supports MERGE (a Snowflake cursor, a DuckDB connection)
+    """
+    refresh_queries = []
+    for table_name in MATERIALIZED_TABLES:
+        setup, refresh = materialization_queries(table_name, database, schema, cluster_by if table_name == FACT_REVIEW else None)
+        # DDL commits implicitly in Snowflake, so it runs before the transaction
+        for query in setup:
+            cursor.execute(query)
+        refresh_queries.append((table_name, refresh))
+
+    cursor.execute('BEGIN')
+    try:
+        for table_name, refresh in refresh_queries:
+            with current_metrics().step(table_name):
+                for query in refresh:
+                    cursor.execute(query)
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+
+@instrumented('transform_data')
+def transform_data():
+    conn, settings = connect_warehouse()
+    database = settings.get('database')
+    schema = settings.get('schema')
+
+    try:
+        with conn.cursor() as cursor:
+            materialize(cursor, database, schema)
+    finally:
+        conn.close()
@@ -1,28 +1,138 @@
-import pandas as pd
-import os
 import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from sentiment_analysis import sentiment_cache
+from sentiment_analysis.sentiment_cache import SentimentCache, analyzer_version, normalize_text, text_hash
+from utils import reviews_io
+from utils.instrumentation import current_metrics, instrumented
+from utils.manifests import content_addressed
+from utils.reviews_io import ANALYZED, CLEANED, read_reviews, reviews_file_path, write_reviews
 
-def analyze_sentiment():
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    reviews_file_path = os.path.join(current_directory, '../reviews.csv')
-    
-    reviews_df = pd.read_csv(reviews_file_path)
-    
-    if 'REVIEW' not in reviews_df.columns:
-        raise KeyError("The 'REVIEW' column is missing from the reviews file.")
-    
+# number of processes scoring reviews (1 = score in the task's own process)
+SENTIMENT_WORKERS = os.cpu_count() or 1
+
+# reviews sent to a worker at a time
+CHUNK_SIZE = 5000
+
+# persistent score cache, stored next to this file (None = disabled)
+SENTIMENT_CACHE_FILE = 'sentiment_cache.sqlite'
+
+# failed reviews logged individually, the rest are only counted
+MAX_REPORTED_FAILURES = 20
+
+# one analyzer per process, created by the pool initializer (or lazily when scoring in-process)
+intensity_analyzer = None
+
+def init_analyzer():
+    global intensity_analyzer
     intensity_analyzer = SentimentIntensityAnalyzer()
-    
-    def calculate_sentiment(text):
+
+def score_reviews(texts):
+    """returns a (compound score, error) pair per review text; failed reviews get (None, error message)"""
+    if intensity_analyzer is None:
+        init_analyzer()
+
+    scores = []
+    for text in texts:
         try:
-            sentiment_score = intensity_analyzer.polarity_scores(text)['compound']
-            return sentiment_score
+            scores.append((intensity_analyzer.polarity_scores(text)['compound'], None))
         except Exception as e:
-            logging.info(f"Error processing review: {text}, error: {e}")
-            return 0
-    
-    reviews_df['SENTIMENT_SCORE'] = reviews_df['REVIEW'].apply(calculate_sentiment)
-    
-    reviews_df.to_csv(reviews_file_path, index=False)
-    
+            scores.append((None, f'{type(e).__name__}: {e}'))
+    return scores
+
+def score_texts(texts, workers, chunk_size):
+    """
+    scores texts in chunks, across a process pool when there is more than one chunk and worker.
+    returns the scores and the number of processes that actually scored them
+    """
+    chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+
+    # daemonic processes (e.g. celery workers) are not allowed to start a process pool
+    if workers > 1 and len(chunks) > 1 and multiprocessing.current_process().daemon:
+        logging.warning(f'Sentiment scoring runs in a daemonic process, which cannot start a process pool: '
+                        f'scoring in-process instead of with {workers} workers')
+    elif workers > 1 and len(chunks) > 1:
+        workers = min(workers, len(chunks))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_analyzer) as executor:
+            return [score for chunk_scores in executor.map(score_reviews, chunks) for score in chunk_scores], workers
+    return [score for chunk in chunks for score in score_reviews(chunk)], 1
+
+@instrumented('analyze_sentiment')
+@content_addressed(
+    'analyze_sentiment',
+    inputs=lambda arguments: [reviews_file_path(CLEANED, arguments['run_id'], arguments['shard'])],
+    outputs=lambda arguments: [reviews_file_path(ANALYZED, arguments['run_id'], arguments['shard'])],
+    modules=[reviews_io, sentiment_cache],
+    packages=['pandas', 'vaderSentiment'],
+    ignored_arguments=['workers', 'chunk_size', 'use_cache']
+)
+def analyze_sentiment(workers=SENTIMENT_WORKERS, chunk_size=CHUNK_SIZE, use_cache=True, shard=None, run_id=None):
+    """
+    adds a SENTIMENT_SCORE column with VADER's compound score for every cleaned review of the run (of one shard, if given).
+    scores are cached by a hash of the normalized review text and the analyzer version, so only new or edited reviews are scored.
+    those are split into chunks and scored across a process pool; results come back in chunk order, so the output is deterministic.
+    reviews that fail to score are logged and stored as null instead of 0
+    """
+    metrics = current_metrics()
+    reviews_df = read_reviews(CLEANED, run_id=run_id, shard=shard)
+
+    if 'REVIEW' not in reviews_df.columns:
+        raise KeyError("The 'REVIEW' column is missing from the reviews file.")
+
+    # reviews without a comment are scored as empty text (neutral, 0.0)
+    texts = [normalize_text(text) for text in reviews_df['REVIEW'].fillna('')]
+    analyzer = analyzer_version()
+    hashes = [text_hash(text, analyzer) for text in texts]
+
+    cache = None
+    cached_scores = {}
+    if use_cache and SENTIMENT_CACHE_FILE is not None:
+        cache = SentimentCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), SENTIMENT_CACHE_FILE), analyzer)
+        with metrics.step('cache_lookup'):
+            cached_scores = cache.get_many(set(hashes))
+
+    try:
+        # score every distinct text that is not cached yet, once
+        missing = {}
+        for hash_, text in zip(hashes, texts):
+            if hash_ not in cached_scores:
+                missing.setdefault(hash_, text)
+
+        start = time.perf_counter()
+        with metrics.step('scoring'):
+            scores, workers_used = score_texts(list(missing.values()), workers, chunk_size)
+            new_results = dict(zip(missing, scores))
+        scoring_seconds = time.perf_counter() - start
+        metrics.set_gauge('scoring_workers', workers_used)
+
+        if cache is not None:
+            with metrics.step('cache_update'):
+                cache.put_many({hash_: score for hash_, (score, error) in new_results.items() if error is None})
+
+            # time saved is estimated from the per-review scoring time of this run, or of the last run that scored anything
+            seconds_per_review = scoring_seconds / len(missing) if missing else cache.get_stat('seconds_per_review')
+            if missing:
+                cache.set_stat('seconds_per_review', seconds_per_review)
+            hits = sum(1 for hash_ in hashes if hash_ in cached_scores)
+            hit_rate = hits / len(hashes) if hashes else 0
+            time_saved = f'{hits * seconds_per_review:.1f}s' if seconds_per_review is not None else 'unknown'
+            logging.info(f'Sentiment cache: {hits} of {len(hashes)} reviews cached ({hit_rate:.1%} hit rate), '
+                         f'{len(missing)} distinct texts scored in {scoring_seconds:.1f}s, estimated time saved: {time_saved}')
+    finally:
+        if cache is not None:
+            cache.close()
+
+    results = [(cached_scores[hash_], None) if hash_ in cached_scores else new_results[hash_] for hash_ in hashes]
+    reviews_df['SENTIMENT_SCORE'] = [score for score, _ in results]
+
+    failed = [(review_id, error) for review_id, (_, error) in zip(reviews_df['REVIEW_ID'], results) if error is not None]
+    if failed:
+        logging.warning(f'{len(failed)} of {len(results)} reviews could not be scored, SENTIMENT_SCORE left empty')
+        for review_id, error in failed[:MAX_REPORTED_FAILURES]:
+            logging.warning(f'Error processing review {review_id}: {error}')
+
+    write_reviews(reviews_df, ANALYZED, run_id=run_id, shard=shard)
+    logging.info(f'Sentiment scores computed for {len(results) - len(failed)} reviews using {workers_used} worker(s)')
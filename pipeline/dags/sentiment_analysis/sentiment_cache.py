@@ -0,0 +1,63 @@
+import hashlib
+import sqlite3
+from utils.manifests import package_version
+
+def analyzer_version():
+    """version of the installed vaderSentiment package, part of every cache key"""
+    return package_version('vaderSentiment')
+
+def normalize_text(text):
+    """collapses whitespace. VADER tokenizes on whitespace, so the score of the normalized text is unchanged"""
+    return ' '.join(text.split())
+
+def text_hash(text, analyzer):
+    return hashlib.sha256(f'{analyzer}\0{text}'.encode('utf-8')).hexdigest()
+
+class SentimentCache:
+    """
+    persistent SQLite cache from hash(analyzer version, normalized review text) to VADER's compound score.
+    entries written by other analyzer versions can never be hit again and are dropped when the cache is opened
+    """
+
+    # sqlite's default limit on bound parameters per statement is 999
+    BATCH_SIZE = 900
+
+    # seconds to wait for another process (e.g. a concurrent shard) holding the write lock
+    LOCK_TIMEOUT = 60
+
+    def __init__(self, cache_file_path, analyzer):
+        self.analyzer = analyzer
+        self.conn = sqlite3.connect(cache_file_path, timeout=self.LOCK_TIMEOUT)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scores (text_hash TEXT PRIMARY KEY, analyzer TEXT NOT NULL, score REAL NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL NOT NULL)')
+        self.conn.execute('DELETE FROM scores WHERE analyzer != ?', (analyzer,))
+        self.conn.commit()
+
+    def get_many(self, hashes):
+        """returns {text_hash: score} for the hashes that are cached"""
+        hashes = list(hashes)
+        scores = {}
+        for start in range(0, len(hashes), self.BATCH_SIZE):
+            batch = hashes[start:start + self.BATCH_SIZE]
+            placeholders = ', '.join('?' * len(batch))
+            scores.update(self.conn.execute(f'SELECT text_hash, score FROM scores WHERE text_hash IN ({placeholders})', batch))
+        return scores
+
+    def put_many(self, scores):
+        """stores {text_hash: score}"""
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO scores (text_hash, analyzer, score) VALUES (?, ?, ?)',
+            ((hash_, self.analyzer, score) for hash_, score in scores.items())
+        )
+        self.conn.commit()
+
+    def get_stat(self, name):
+        row = self.conn.execute('SELECT value FROM stats WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_stat(self, name, value):
+        self.conn.execute('INSERT OR REPLACE INTO stats (name, value) VALUES (?, ?)', (name, value))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
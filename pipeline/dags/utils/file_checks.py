@@ -1,46 +1,42 @@
 import logging
 import os
+from data_collection.get_reviews.get_reviews import PROFESSORS_FILE, SCHOOL_IDS, partition_file_path, school_directory
+from utils.manifests import check_stage_outputs
+from utils.reviews_io import raw_reviews_file_path
 
-def check_professors_file():
-    """checks if get_reviews/professors.json exists"""
+def check_professors_file(school_ids=SCHOOL_IDS):
+    """checks if professors.json exists for every school"""
 
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_directory, '../data_collection/get_reviews/professors.json')
-    if not os.path.exists(file_path):
-        logging.error('ERROR: get_reviews/professors.json not found.')
-        raise FileNotFoundError('ERROR: get_reviews/professors.json not found.')
-    else:
-        logging.info('SUCCESS: professors.json exists')
+    for school_id in school_ids:
+        file_path = os.path.join(school_directory(school_id), PROFESSORS_FILE)
+        if not os.path.exists(file_path):
+            logging.error(f'ERROR: professors.json not found for school {school_id}.')
+            raise FileNotFoundError(f'ERROR: professors.json not found for school {school_id}.')
+    logging.info('SUCCESS: professors.json exists for every school')
 
-def check_reviews_file():
-    """checks if reviews.csv exists"""
+def check_reviews_partitions(school_ids=SCHOOL_IDS, run_id=None):
+    """checks if the run's reviews.csv partition exists for every school"""
 
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_directory, '../reviews.csv')
-    if not os.path.exists(file_path):
-        logging.error('ERROR: reviews.csv not found.')
-        raise FileNotFoundError('ERROR: reviews.csv not found.')
-    else:
-        logging.info('SUCCESS: reviews.csv exists')
+    for school_id in school_ids:
+        if not os.path.exists(partition_file_path(school_id, run_id)):
+            logging.error(f'ERROR: reviews.csv partition not found for school {school_id}.')
+            raise FileNotFoundError(f'ERROR: reviews.csv partition not found for school {school_id}.')
+    logging.info('SUCCESS: reviews.csv partition exists for every school')
 
-def check_cleaned_reviews_file():
-    """checks if reviews.csv exists"""
+def check_reviews_file(run_id=None):
+    """checks if the run's reviews.csv exists"""
 
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_directory, '../reviews.csv')
+    file_path = raw_reviews_file_path(run_id)
     if not os.path.exists(file_path):
         logging.error('ERROR: reviews.csv not found.')
         raise FileNotFoundError('ERROR: reviews.csv not found.')
     else:
         logging.info('SUCCESS: reviews.csv exists')
 
-def check_analyzed_reviews_file():
-    """checks if reviews.csv exists"""
+def check_cleaned_reviews_file(run_id=None):
+    """checks if the run's cleaned reviews file is exactly what clean_data wrote"""
+    check_stage_outputs('clean_data', run_id)
 
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_directory, '../reviews.csv')
-    if not os.path.exists(file_path):
-        logging.error('ERROR: reviews.csv not found.')
-        raise FileNotFoundError('ERROR: reviews.csv not found.')
-    else:
-        logging.info('SUCCESS: reviews.csv exists')
\ No newline at end of file
+def check_analyzed_reviews_file(stage='analyze_sentiment', run_id=None):
+    """checks if the run's analyzed reviews file is exactly what analyze_sentiment (or merge_shards) wrote"""
+    check_stage_outputs(stage, run_id)
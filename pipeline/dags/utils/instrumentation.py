@@ -0,0 +1,196 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import resource
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# pipeline/dags
+DAGS_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# one JSON line per stage run (None = disabled)
+METRICS_FILE = os.path.join(DAGS_DIRECTORY, 'metrics', 'stage_metrics.jsonl')
+
+# 'host:port' of a StatsD server that also receives every stage's metrics over UDP (None = disabled)
+STATSD_ADDRESS = os.environ.get('RMC_STATSD_ADDRESS')
+STATSD_PREFIX = 'rate_my_class'
+
+# metrics of the stage running in the current context, see current_metrics
+_current_metrics = contextvars.ContextVar('stage_metrics', default=None)
+
+def peak_rss_megabytes(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss / 2 ** 10
+
+def cpu_seconds():
+    """cpu time of this process and its finished child processes (e.g. the sentiment process pool)"""
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+class StageMetrics:
+    """
+    counters and timings of one stage run. safe to update from several threads.
+    rows_in/rows_out and bytes_read/bytes_written are filled in by the stage (utils/reviews_io.py counts the reviews files it
+    reads and writes), sub-step timings are recorded with step() and stage-specific values (e.g. worker counts) with set_gauge()
+    """
+
+    def __init__(self, stage, run_id=None, shard=None):
+        self.stage = stage
+        self.run_id = run_id
+        self.shard = shard
+        self.status = 'running'
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.steps = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def add(self, **counters):
+        """adds to rows_in, rows_out, bytes_read or bytes_written"""
+        with self._lock:
+            for counter, value in counters.items():
+                setattr(self, counter, getattr(self, counter) + value)
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def read_file(self, file_path, rows=0):
+        self.add(bytes_read=os.path.getsize(file_path), rows_in=rows)
+
+    def wrote_file(self, file_path, rows=0):
+        self.add(bytes_written=os.path.getsize(file_path), rows_out=rows)
+
+    @contextmanager
+    def step(self, name):
+        """times a sub-step. repeated steps (e.g. one per department or school) add up, and their number is counted"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                step = self.steps.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                step['seconds'] += seconds
+                step['calls'] += 1
+
+    @contextmanager
+    def measure(self):
+        """records wall time, cpu time and peak rss around the stage, and its status once it finishes"""
+        start_time = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        start_cpu = cpu_seconds()
+        try:
+            yield self
+            if self.status == 'running':
+                self.status = 'success'
+        except BaseException:
+            self.status = 'failed'
+            raise
+        finally:
+            self.started_at = start_time.isoformat()
+            self.wall_seconds = time.perf_counter() - start
+            self.cpu_seconds = cpu_seconds() - start_cpu
+            self.peak_rss_mb = peak_rss_megabytes()
+            self.children_peak_rss_mb = peak_rss_megabytes(resource.RUSAGE_CHILDREN)
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'run_id': self.run_id,
+            'shard': self.shard,
+            'status': self.status,
+            'started_at': self.started_at,
+            'wall_seconds': round(self.wall_seconds, 3),
+            'cpu_seconds': round(self.cpu_seconds, 3),
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+            'children_peak_rss_mb': round(self.children_peak_rss_mb, 1),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'steps': {name: {'seconds': round(step['seconds'], 3), 'calls': step['calls']} for name, step in self.steps.items()},
+            'gauges': dict(self.gauges),
+        }
+
+def current_metrics():
+    """
+    metrics of the stage running in this context. outside of a stage (or in a worker thread, which does not inherit the context)
+    a throwaway StageMetrics is returned, so code can always record into it
+    """
+    metrics = _current_metrics.get()
+    return metrics if metrics is not None else StageMetrics(None)
+
+def write_metrics_file(metrics):
+    os.makedirs(os.path.dirname(METRICS_FILE), exist_ok=True)
+    with open(METRICS_FILE, 'a') as file:
+        file.write(json.dumps(metrics) + '\n')
+
+def send_statsd(metrics):
+    """timings in milliseconds, everything else as gauges, tagged by stage in the metric name"""
+    host, port = STATSD_ADDRESS.rsplit(':', 1)
+    prefix = f"{STATSD_PREFIX}.{metrics['stage']}"
+    lines = [
+        f"{prefix}.wall_time:{metrics['wall_seconds'] * 1000:.0f}|ms",
+        f"{prefix}.cpu_time:{metrics['cpu_seconds'] * 1000:.0f}|ms",
+        f"{prefix}.peak_rss_mb:{metrics['peak_rss_mb']}|g",
+        f"{prefix}.rows_in:{metrics['rows_in']}|g",
+        f"{prefix}.rows_out:{metrics['rows_out']}|g",
+        f"{prefix}.bytes_read:{metrics['bytes_read']}|g",
+        f"{prefix}.bytes_written:{metrics['bytes_written']}|g",
+        f"{prefix}.{metrics['status']}:1|c",
+    ]
+    lines += [f"{prefix}.step.{name}:{step['seconds'] * 1000:.0f}|ms" for name, step in metrics['steps'].items()]
+    lines += [f"{prefix}.{name}:{value}|g" for name, value in metrics['gauges'].items()]
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for line in lines:
+            sock.sendto(line.encode('utf-8'), (host, int(port)))
+
+def emit(metrics):
+    """logs a stage's metrics and sends them to the configured sinks. a failing sink never fails the stage"""
+    metrics = metrics.to_dict()
+    logging.info(f"Stage metrics: {json.dumps(metrics)}")
+
+    try:
+        if METRICS_FILE is not None:
+            write_metrics_file(metrics)
+        if STATSD_ADDRESS is not None:
+            send_statsd(metrics)
+    except OSError as e:
+        logging.warning(f'Stage metrics could not be sent: {e}')
+
+def instrumented(stage):
+    """
+    decorates a pipeline stage so every run emits its metrics: wall time, cpu time, peak rss, rows and bytes in and out,
+    and sub-step timings. the stage's run_id and shard arguments, if it has them, are recorded with the metrics.
+    inside the stage, current_metrics() returns the StageMetrics being recorded
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            metrics = StageMetrics(stage, bound.arguments.get('run_id'), bound.arguments.get('shard'))
+
+            token = _current_metrics.set(metrics)
+            try:
+                with metrics.measure():
+                    return func(*args, **kwargs)
+            finally:
+                _current_metrics.reset(token)
+                emit(metrics)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,201 @@
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import sys
+import time
+from importlib.metadata import version, PackageNotFoundError
+from utils.instrumentation import current_metrics
+from utils.reviews_io import DAGS_DIRECTORY, atomic_write, link_atomically, run_directory
+
+# manifests of every stage run, stored by stage and key, plus a content-addressed copy of every output they refer to
+MANIFESTS_DIRECTORY = os.path.join(DAGS_DIRECTORY, 'manifests')
+OBJECTS_DIRECTORY = os.path.join(MANIFESTS_DIRECTORY, 'objects')
+
+# manifests not used for this many days are removed, together with the outputs only they refer to
+MANIFEST_RETENTION_DAYS = 30
+
+# set to False to always run every stage
+SKIP_UNCHANGED_STAGES = True
+
+def file_hash(file_path):
+    """sha256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def package_version(package):
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return 'unknown'
+
+def code_version(modules, packages):
+    """sha256 of the source of the given modules and the installed versions of the given packages"""
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(inspect.getsourcefile(module), 'rb') as file:
+            digest.update(file.read())
+    for package in packages:
+        digest.update(f'{package}=={package_version(package)}'.encode('utf-8'))
+    return digest.hexdigest()
+
+def manifest_path(stage, key):
+    return os.path.join(MANIFESTS_DIRECTORY, stage, f'{key}.json')
+
+def run_manifest_path(stage, run_id=None, shard=None):
+    """copy of the manifest of a stage in one run, checked by utils/file_checks.py"""
+    file_name = f'{stage}.json' if shard is None else f'{stage}.shard={shard}.json'
+    return os.path.join(run_directory(run_id), 'manifests', file_name)
+
+def load_manifest(file_path):
+    if not os.path.exists(file_path):
+        return None
+
+    with open(file_path, 'r') as file:
+        return json.load(file)
+
+def write_manifest(manifest, file_path):
+    with atomic_write(file_path) as temp_file_path, open(temp_file_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+def store_object(file_path, digest):
+    """keeps an output under its hash, shared by every manifest that refers to the same contents"""
+    object_path = os.path.join(OBJECTS_DIRECTORY, digest)
+    if not os.path.exists(object_path):
+        link_atomically(file_path, object_path)
+
+def restore_outputs(manifest, file_paths):
+    """
+    puts the outputs recorded in a manifest at this run's output paths (in the same order).
+    outputs that already hold the recorded contents are left alone, the others are linked from the object store.
+    returns False if a stored output is missing
+    """
+    digests = list(manifest['outputs'].values())
+    for file_path, digest in zip(file_paths, digests):
+        if os.path.exists(file_path) and file_hash(file_path) == digest:
+            continue
+
+        object_path = os.path.join(OBJECTS_DIRECTORY, digest)
+        if not os.path.exists(object_path):
+            return False
+        link_atomically(object_path, file_path)
+    return True
+
+def collect_garbage():
+    """removes manifests unused for MANIFEST_RETENTION_DAYS, then stored outputs that no manifest refers to anymore"""
+    if not os.path.exists(OBJECTS_DIRECTORY):
+        return
+
+    expired = time.time() - MANIFEST_RETENTION_DAYS * 24 * 60 * 60
+    referenced = set()
+    for stage in os.scandir(MANIFESTS_DIRECTORY):
+        if not stage.is_dir() or stage.path == OBJECTS_DIRECTORY:
+            continue
+        for entry in os.scandir(stage.path):
+            if not entry.name.endswith('.json'):
+                continue
+            if entry.stat().st_mtime < expired:
+                os.remove(entry.path)
+                continue
+            with open(entry.path, 'r') as file:
+                referenced.update(json.load(file)['outputs'].values())
+
+    for entry in os.scandir(OBJECTS_DIRECTORY):
+        if entry.name not in referenced and not entry.name.endswith('.tmp'):
+            os.remove(entry.path)
+
+def stage_key(inputs, code, arguments):
+    """
+    identifies a stage run by what it depends on: input contents (in order, not paths, which change every run),
+    code version and arguments
+    """
+    return hashlib.sha256(json.dumps({'inputs': inputs, 'code': code, 'arguments': arguments}, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def content_addressed(stage, inputs, outputs, modules=(), packages=(), ignored_arguments=()):
+    """
+    decorates a pipeline stage so it is skipped when nothing it depends on has changed since its last successful run.
+    inputs and outputs are functions from the stage's arguments (a dict, defaults applied) to lists of file paths.
+    the stage depends on the contents of its inputs, its arguments (except run_id and ignored_arguments, e.g. worker counts),
+    the source of its own module and of `modules`, and the installed versions of `packages`.
+    a stage whose key was seen before restores the outputs recorded for it instead of running, in any later run.
+    after every run, a manifest with the input hashes, code version and output hashes is stored under its key,
+    and a copy is kept in the run's directory
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        stage_modules = [sys.modules[func.__module__], *modules]
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            shard = arguments.get('shard')
+            run_id = arguments.get('run_id')
+
+            metrics = current_metrics()
+            with metrics.step('hash_inputs'):
+                input_hashes = {file_path: file_hash(file_path) for file_path in inputs(arguments)}
+                code = code_version(stage_modules, packages)
+            key_arguments = {name: value for name, value in arguments.items() if name != 'run_id' and name not in ignored_arguments}
+            key = stage_key(list(input_hashes.values()), code, key_arguments)
+            output_paths = outputs(arguments)
+
+            manifest = load_manifest(manifest_path(stage, key))
+            with metrics.step('restore_outputs'):
+                restored = SKIP_UNCHANGED_STAGES and manifest is not None and restore_outputs(manifest, output_paths)
+            if restored:
+                os.utime(manifest_path(stage, key))
+                manifest.update(run_id=run_id, inputs=input_hashes, outputs=dict(zip(output_paths, manifest['outputs'].values())))
+                write_manifest(manifest, run_manifest_path(stage, run_id, shard))
+                logging.info(f"Stage '{stage}' skipped: inputs, code and arguments are unchanged since a previous run")
+                metrics.status = 'skipped'
+                return None
+
+            result = func(*args, **kwargs)
+
+            with metrics.step('hash_outputs'):
+                output_hashes = {file_path: file_hash(file_path) for file_path in output_paths}
+            manifest = {
+                'stage': stage,
+                'shard': shard,
+                'run_id': run_id,
+                'key': key,
+                'inputs': input_hashes,
+                'code_version': code,
+                'arguments': {name: repr(value) for name, value in arguments.items()},
+                'outputs': output_hashes,
+            }
+
+            # the manifest goes first: once an output is stored, it is already referenced and safe from a concurrent collect_garbage
+            write_manifest(manifest, manifest_path(stage, key))
+            write_manifest(manifest, run_manifest_path(stage, run_id, shard))
+            for file_path, digest in output_hashes.items():
+                store_object(file_path, digest)
+            collect_garbage()
+            return result
+
+        return wrapper
+    return decorator
+
+def check_stage_outputs(stage, run_id=None, shard=None):
+    """checks that a stage's outputs in a run exist and hold exactly the contents recorded by its manifest"""
+    manifest = load_manifest(run_manifest_path(stage, run_id, shard))
+    if manifest is None:
+        logging.error(f"ERROR: no manifest for stage '{stage}'.")
+        raise FileNotFoundError(f"ERROR: no manifest for stage '{stage}'.")
+
+    for file_path, digest in manifest['outputs'].items():
+        file_name = os.path.basename(file_path)
+        if not os.path.exists(file_path):
+            logging.error(f'ERROR: {file_name} not found.')
+            raise FileNotFoundError(f'ERROR: {file_name} not found.')
+        if file_hash(file_path) != digest:
+            logging.error(f"ERROR: {file_name} does not match the output of stage '{stage}'.")
+            raise ValueError(f"ERROR: {file_name} does not match the output of stage '{stage}'.")
+        logging.info(f"SUCCESS: {file_name} matches the output of stage '{stage}'")
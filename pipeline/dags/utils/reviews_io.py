@@ -0,0 +1,251 @@
+import os
+import re
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+import pandas as pd
+from utils.instrumentation import current_metrics
+
+# format of the reviews file handed from clean_data to analyze_sentiment and store_data: 'parquet' or 'csv'
+INTERMEDIATE_FORMAT = 'parquet'
+
+# pipeline/dags
+DAGS_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# every DAG run writes the output of each stage to its own directory, runs/<run id>/[shard=<shard>/]<stage>,
+# and never modifies a file once it is complete, so retries, overlapping runs and backfills never read each other's data
+RUNS_DIRECTORY = 'runs'
+
+# run id of stages run outside of Airflow (e.g. python -m data_cleaning.clean_data)
+DEFAULT_RUN_ID = 'manual'
+
+# number of most recently published run directories kept, older published runs are removed once a run is published.
+# runs that are still in progress are never removed, unless nothing in them changed for ABANDONED_RUN_DAYS (e.g. a failed run)
+RUN_RETENTION = 5
+ABANDONED_RUN_DAYS = 7
+
+# marks a run directory whose reviews were published, written by publish_reviews
+PUBLISHED_MARKER = '.published'
+
+# stages handing reviews to each other
+COLLECTED = 'get_reviews'
+CLEANED = 'clean_data'
+ANALYZED = 'analyze_sentiment'
+
+# reviews.csv as written by get_reviews
+RAW_REVIEWS_FILE = 'reviews.csv'
+
+# copies of the latest collected and the latest loaded reviews in pipeline/dags, replaced atomically.
+# LATEST_RAW_REVIEWS_FILE can be reused by a run that skips get_reviews, the dashboard's duckdb backend reads LATEST_REVIEWS_FILE
+LATEST_RAW_REVIEWS_FILE = 'reviews.csv'
+LATEST_REVIEWS_FILE = 'analyzed_reviews'
+
+RAW_REVIEW_SCHEMA = {
+    'School ID': 'int64',
+    'School Name': 'string',
+    'Professor ID': 'int64',
+    'Professor Name': 'string',
+    'Overall Quality': 'float64',
+    'Overall Difficulty': 'float64',
+    'Department': 'string',
+    'Review ID': 'int64',
+    'Course Code': 'string',
+    'Review Date': 'string',
+    'Quality': 'float64',
+    'Difficulty': 'float64',
+    'Review Text': 'string',
+    'Would Take Again': 'boolean',
+    'Grade': 'string',
+    'Attendance': 'string',
+    'Textbook Usage': 'boolean',
+    'Thumbs Up': 'int64',
+    'Thumbs Down': 'int64',
+}
+
+# reviews after clean_data (and analyze_sentiment, which adds SENTIMENT_SCORE)
+REVIEW_SCHEMA = {
+    'SCHOOL_ID': 'int64',
+    'SCHOOL_NAME': 'string',
+    'PROFESSOR_ID': 'int64',
+    'PROFESSOR_NAME': 'string',
+    'OVERALL_QUALITY': 'float64',
+    'OVERALL_DIFFICULTY': 'float64',
+    'DEPARTMENT_NAME': 'string',
+    'REVIEW_ID': 'int64',
+    'COURSE_CODE': 'string',
+    'DATE': 'string',
+    'QUALITY': 'float64',
+    'DIFFICULTY': 'float64',
+    'REVIEW': 'string',
+    'WOULD_TAKE_AGAIN': 'boolean',
+    'GRADE': 'string',
+    'ATTENDANCE': 'string',
+    'TEXTBOOK_USAGE': 'boolean',
+    'THUMBS_UP': 'int64',
+    'THUMBS_DOWN': 'int64',
+    'DEPARTMENT_ID': 'int64',
+    'CLASS_ID': 'int64',
+    'SENTIMENT_SCORE': 'float64',
+}
+
+def run_directory(run_id=None):
+    """directory of one DAG run, named after its run id"""
+    return os.path.join(DAGS_DIRECTORY, RUNS_DIRECTORY, re.sub(r'[^A-Za-z0-9_.+-]', '_', run_id or DEFAULT_RUN_ID))
+
+def stage_directory(stage, run_id=None, shard=None):
+    """directory of one stage's output in a run, or in one shard of a run"""
+    directory = run_directory(run_id)
+    if shard is not None:
+        directory = os.path.join(directory, f'shard={shard}')
+    return os.path.join(directory, stage)
+
+def raw_reviews_file_path(run_id=None, shard=None):
+    return os.path.join(stage_directory(COLLECTED, run_id, shard), RAW_REVIEWS_FILE)
+
+def reviews_file_path(stage, run_id=None, shard=None, file_format=INTERMEDIATE_FORMAT):
+    """path of the reviews file written by a stage (CLEANED or ANALYZED) in a run, of the whole dataset or of one shard"""
+    if file_format not in ('parquet', 'csv'):
+        raise ValueError(f"ERROR: unsupported intermediate format '{file_format}'")
+    return os.path.join(stage_directory(stage, run_id, shard), f'reviews.{file_format}')
+
+def latest_reviews_file_path(file_format=INTERMEDIATE_FORMAT):
+    return os.path.join(DAGS_DIRECTORY, f'{LATEST_REVIEWS_FILE}.{file_format}')
+
+def temporary_path(file_path):
+    """unique temporary file next to file_path, so os.replace onto it is atomic"""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    fd, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=f'.{os.path.basename(file_path)}.', suffix='.tmp')
+    os.close(fd)
+    return temp_file_path
+
+@contextmanager
+def atomic_write(file_path):
+    """
+    yields a temporary path to write file_path's contents to, renamed to file_path once the block completes (and removed
+    if it fails), so readers see either the previous file or the complete new one. the temporary name is unique,
+    so overlapping runs writing the same file never write to each other's temporary file
+    """
+    temp_file_path = temporary_path(file_path)
+    try:
+        yield temp_file_path
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        os.remove(temp_file_path)
+        raise
+
+def link_atomically(source_path, target_path):
+    """
+    makes target_path a hard link to source_path (a copy across file systems), replacing it atomically.
+    only used for complete files, which are never modified afterwards
+    """
+    # renaming a link onto another link to the same file does nothing, and would leave the temporary file behind
+    if os.path.exists(target_path) and os.path.samefile(source_path, target_path):
+        return
+
+    temp_file_path = temporary_path(target_path)
+    os.remove(temp_file_path)
+    try:
+        os.link(source_path, temp_file_path)
+    except OSError:
+        shutil.copyfile(source_path, temp_file_path)
+    os.replace(temp_file_path, target_path)
+
+def read_raw_reviews(run_id=None, shard=None):
+    """reads get_reviews' reviews.csv with explicit dtypes instead of inferring them"""
+    file_path = raw_reviews_file_path(run_id, shard)
+    data = pd.read_csv(file_path, dtype=RAW_REVIEW_SCHEMA)
+    current_metrics().read_file(file_path, rows=len(data))
+    return data
+
+def read_reviews(stage, columns=None, file_format=INTERMEDIATE_FORMAT, categories=None, run_id=None, shard=None):
+    """reads the reviews file written by a stage, see read_reviews_file"""
+    return read_reviews_file(reviews_file_path(stage, run_id, shard, file_format), columns, categories)
+
+def read_reviews_file(file_path, columns=None, categories=None):
+    """
+    reads a reviews file (e.g. a stage's output or the latest published reviews), parquet or csv by its extension,
+    optionally only the given columns. with parquet, columns that are not requested (e.g. REVIEW) are never read from disk.
+    columns listed in categories are read as pandas categoricals, without materializing one string per row
+    """
+    file_format = os.path.splitext(file_path)[1].lstrip('.')
+    if file_format not in ('parquet', 'csv'):
+        raise ValueError(f"ERROR: unsupported reviews file format '{file_format}'")
+    categories = list(categories or [])
+
+    if file_format == 'parquet':
+        data = pd.read_parquet(file_path, columns=columns, read_dictionary=categories)
+    else:
+        header = pd.read_csv(file_path, nrows=0).columns
+        dtypes = {column: dtype for column, dtype in REVIEW_SCHEMA.items() if column in header}
+        dtypes.update({column: 'category' for column in categories if column in header})
+        data = pd.read_csv(file_path, usecols=columns, dtype=dtypes)
+
+    current_metrics().read_file(file_path, rows=len(data))
+    return data
+
+def write_reviews(data, stage, file_format=INTERMEDIATE_FORMAT, run_id=None, shard=None):
+    """
+    writes a stage's reviews file, casting known columns to REVIEW_SCHEMA first.
+    the file is written atomically, so it is either missing or whole
+    """
+    data = data.astype({column: dtype for column, dtype in REVIEW_SCHEMA.items() if column in data.columns})
+    file_path = reviews_file_path(stage, run_id, shard, file_format)
+
+    with atomic_write(file_path) as temp_file_path:
+        if file_format == 'parquet':
+            data.to_parquet(temp_file_path, index=False)
+        else:
+            data.to_csv(temp_file_path, index=False)
+    current_metrics().wrote_file(file_path, rows=len(data))
+
+def reuse_raw_reviews(run_id=None):
+    """
+    uses the latest collected reviews.csv as this run's get_reviews output, instead of collecting again
+    (e.g. to backfill or rerun the later stages)
+    """
+    latest_file_path = os.path.join(DAGS_DIRECTORY, LATEST_RAW_REVIEWS_FILE)
+    if not os.path.exists(latest_file_path):
+        raise FileNotFoundError(f'ERROR: {LATEST_RAW_REVIEWS_FILE} not found, run get_reviews at least once.')
+    link_atomically(latest_file_path, raw_reviews_file_path(run_id))
+
+def publish_raw_reviews(run_id=None):
+    link_atomically(raw_reviews_file_path(run_id), os.path.join(DAGS_DIRECTORY, LATEST_RAW_REVIEWS_FILE))
+
+def publish_reviews(run_id=None, file_format=INTERMEDIATE_FORMAT):
+    """makes a run's analyzed reviews the latest ones, marks the run as published and removes old runs (see prune_runs)"""
+    link_atomically(reviews_file_path(ANALYZED, run_id, file_format=file_format), latest_reviews_file_path(file_format))
+    with atomic_write(os.path.join(run_directory(run_id), PUBLISHED_MARKER)):
+        pass
+    prune_runs(run_id)
+
+def last_modified(directory):
+    """modification time of the most recently changed file or directory under directory"""
+    return max(
+        os.path.getmtime(path)
+        for root, _, files in os.walk(directory)
+        for path in [root, *(os.path.join(root, file_name) for file_name in files)]
+    )
+
+def prune_runs(run_id=None):
+    """
+    removes published runs beyond the RUN_RETENTION most recently published ones, and runs abandoned for ABANDONED_RUN_DAYS.
+    a run that is still in progress (e.g. an older run of a backfill, or an overlapping DAG run) is never removed
+    """
+    runs_directory = os.path.join(DAGS_DIRECTORY, RUNS_DIRECTORY)
+    current_run_directory = run_directory(run_id)
+    abandoned = time.time() - ABANDONED_RUN_DAYS * 24 * 60 * 60
+
+    published = []
+    for entry in os.scandir(runs_directory):
+        if not entry.is_dir() or entry.path == current_run_directory:
+            continue
+        marker_path = os.path.join(entry.path, PUBLISHED_MARKER)
+        if os.path.exists(marker_path):
+            published.append((os.path.getmtime(marker_path), entry.path))
+        elif last_modified(entry.path) < abandoned:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    # the current run counts as the most recently published one
+    for _, path in sorted(published, reverse=True)[RUN_RETENTION - 1:]:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,53 @@
+import logging
+import pandas as pd
+from data_cleaning import clean_data
+from data_cleaning.clean_data import assign_ids
+from data_collection.get_reviews.get_reviews import SCHOOL_IDS
+from utils import reviews_io
+from utils.instrumentation import current_metrics, instrumented
+from utils.manifests import content_addressed
+from utils.reviews_io import ANALYZED, REVIEW_SCHEMA, read_reviews, reviews_file_path, write_reviews
+
+# number of shards the sharded pipeline splits SCHOOL_IDS into (at most one school per shard)
+SHARD_COUNT = 4
+
+def plan_shards(school_ids=SCHOOL_IDS, shard_count=SHARD_COUNT):
+    """
+    splits school_ids into at most shard_count contiguous shards of (almost) equal size, as [{'shard': n, 'school_ids': [...]}].
+    shards are sharded by school because course codes are grouped per department of a school, so a shard always holds
+    every review the cleaning of its schools depends on. shards keep the order of school_ids, so merged shards are in
+    the same order as an unsharded run
+    """
+    shard_count = max(1, min(shard_count, len(school_ids)))
+    size, remainder = divmod(len(school_ids), shard_count)
+
+    shards = []
+    start = 0
+    for shard in range(shard_count):
+        end = start + size + (1 if shard < remainder else 0)
+        shards.append({'shard': shard, 'school_ids': list(school_ids[start:end])})
+        start = end
+    return shards
+
+@instrumented('merge_shards')
+@content_addressed(
+    'merge_shards',
+    inputs=lambda arguments: [reviews_file_path(ANALYZED, arguments['run_id'], shard['shard']) for shard in arguments['shards']],
+    outputs=lambda arguments: [reviews_file_path(ANALYZED, arguments['run_id'])],
+    modules=[reviews_io, clean_data],
+    packages=['pandas']
+)
+def merge_shards(shards, run_id=None):
+    """
+    concatenates the analyzed reviews of every shard of the run into the run's analyzed reviews file read by data_storage,
+    and assigns DEPARTMENT_ID and CLASS_ID over the whole dataset
+    """
+    data = pd.concat([read_reviews(ANALYZED, run_id=run_id, shard=shard['shard']) for shard in shards], ignore_index=True)
+    with current_metrics().step('assign_ids'):
+        data = assign_ids(data)
+
+    # same column order as an unsharded run, where ids are assigned before SENTIMENT_SCORE is added
+    data = data[[column for column in REVIEW_SCHEMA if column in data.columns]]
+
+    write_reviews(data, ANALYZED, run_id=run_id)
+    logging.info(f'Merged {len(shards)} shards into {len(data)} reviews')
@@ -0,0 +1,25 @@
+from snowflake.connector import connect
+
+# Airflow connection holding the Snowflake login and password; its extra holds account, warehouse, database and schema
+SNOWFLAKE_CONN_ID = 'snowflake_default'
+
+def connect_warehouse(conn_id=SNOWFLAKE_CONN_ID):
+    """
+    opens a Snowflake connection from the Airflow connection conn_id.
+    returns it with the connection's extra settings (account, warehouse, database, schema)
+    """
+    # imported here, so modules that only reuse the pipeline's SQL (e.g. the dashboard's DuckDB backend) do not need Airflow
+    from airflow.hooks.base import BaseHook
+
+    conn_details = BaseHook.get_connection(conn_id)
+    settings = conn_details.extra_dejson
+
+    conn = connect(
+        user=conn_details.login,
+        password=conn_details.password,
+        account=settings.get('account'),
+        warehouse=settings.get('warehouse'),
+        database=settings.get('database'),
+        schema=settings.get('schema')
+    )
+    return conn, settings
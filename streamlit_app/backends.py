@@ -0,0 +1,99 @@
+import os
+import sys
+import threading
+import duckdb
+import pandas as pd
+import snowflake.connector
+from snowflake_info import SnowflakeInfo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline', 'dags'))
+from data_storage.sql_loader import duckdb_writer
+from data_storage.store_data import REVIEW_COLUMNS, split_tables, table_creation_queries
+from data_summarization.summarize_data import build_rollups
+from data_transformation.transform_data import FACT_REVIEW, materialize
+from utils.reviews_io import latest_reviews_file_path, read_reviews_file
+
+# where the dashboard's queries run: 'snowflake' (the warehouse loaded by the pipeline)
+# or 'duckdb' (an embedded engine over the pipeline's reviews file, no warehouse or network needed)
+DASHBOARD_BACKEND = os.environ.get('RMC_BACKEND', 'snowflake')
+
+# latest analyzed reviews published by the pipeline (in its INTERMEDIATE_FORMAT), read by the duckdb backend
+LOCAL_REVIEWS_FILE = os.environ.get('RMC_REVIEWS_FILE', latest_reviews_file_path())
+
+# server-side binding of query parameters (the connector's default, pyformat, formats them into the SQL on the client)
+snowflake.connector.paramstyle = 'qmark'
+
+class SnowflakeBackend:
+    """runs queries on one Snowflake connection, reopened if the session was closed"""
+
+    def __init__(self):
+        self.conn = self._connect()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return snowflake.connector.connect(
+            user=f'{SnowflakeInfo.USERNAME}',
+            password=f'{SnowflakeInfo.PASSWORD}',
+            account=f'{SnowflakeInfo.ACCOUNT}',
+            database=f'{SnowflakeInfo.DATABASE}',
+            schema=f'{SnowflakeInfo.SCHEMA}',
+            client_session_keep_alive=True
+        )
+
+    def query(self, query, params=()):
+        with self._lock:
+            if self.conn.is_closed():
+                self.conn = self._connect()
+            conn = self.conn
+
+        with conn.cursor() as cursor:
+            cursor.execute(query, params)
+            data = cursor.fetchall()
+            columns = [desc[0] for desc in cursor.description]
+        return pd.DataFrame(data, columns=columns)
+
+class DuckDBBackend:
+    """
+    runs queries on an in-memory DuckDB database holding the dashboard's tables (dimensions, rollups and PIPELINE_LOADS),
+    built once from the pipeline's reviews file (parquet or csv) with the pipeline's own code: store_data splits the reviews
+    into the normalized tables, transform_data materializes fact_review and the dim_* tables, and summarize_data builds the rollups.
+    LOADED_AT is the file's modification time, so a new pipeline run shows up as a new load
+    """
+
+    def __init__(self, reviews_file=LOCAL_REVIEWS_FILE):
+        self.conn = duckdb.connect()
+        normalized_tables = table_creation_queries(foreign_keys=False)
+        for query in normalized_tables.values():
+            self.conn.execute(query)
+
+        write_dataframe = duckdb_writer(self.conn)
+        for table_name, dataframe in split_tables(read_reviews_file(reviews_file, columns=REVIEW_COLUMNS)).items():
+            write_dataframe(dataframe, table_name)
+
+        materialize(self.conn, cluster_by=None)
+        build_rollups(self.conn)
+        self.conn.execute('CREATE TABLE PIPELINE_LOADS AS SELECT to_timestamp(?) AS LOADED_AT', [os.path.getmtime(reviews_file)])
+
+        # the dashboard only reads the dimensions and rollups, fact_review was only needed to build the rollups
+        for table_name in [*normalized_tables, FACT_REVIEW]:
+            self.conn.execute(f'DROP TABLE {table_name}')
+
+    def query(self, query, params=()):
+        # a duckdb connection is not thread-safe, every query gets its own cursor on the shared database
+        with self.conn.cursor() as cursor:
+            data = cursor.execute(query, params).df()
+        data.columns = [column.upper() for column in data.columns]
+        return data
+
+def backend_version(backend=DASHBOARD_BACKEND):
+    """changes whenever the backend has to be rebuilt: the reviews file's modification time for duckdb"""
+    if backend == 'duckdb':
+        return os.path.getmtime(LOCAL_REVIEWS_FILE)
+    return None
+
+def create_backend(backend=DASHBOARD_BACKEND):
+    if backend == 'snowflake':
+        return SnowflakeBackend()
+    if backend == 'duckdb':
+        return DuckDBBackend()
+    raise ValueError(f"ERROR: unsupported dashboard backend '{backend}'")
@@ -0,0 +1,207 @@
+# every query the dashboard runs, by name.
+# charts read the rollup tables built by the pipeline's data_summarization task instead of scanning FACT_REVIEW,
+# averages are re-aggregated from their sums and counts: SUM(x_SUM) / SUM(x_COUNT).
+# the SQL sticks to what Snowflake and DuckDB both understand, so every backend runs the same queries.
+# drilldown values are bound as parameters (qmark style, ?), never formatted into the SQL, so every query is one
+# statement the warehouse can reuse plans and results for, whatever department or class is selected.
+# rollups are monthly, so "past 5 years" starts at the beginning of the month 5 years ago
+QUERIES = {
+    # time of the pipeline's latest load (see pipeline/dags/data_summarization/summarize_data.py)
+    'load_version': """
+SELECT MAX(LOADED_AT) AS LOADED_AT
+FROM PIPELINE_LOADS
+""",
+    'quality_by_department': """
+SELECT 
+    d.department_name AS department_name, 
+    SUM(r.QUALITY_SUM) / NULLIF(SUM(r.QUALITY_COUNT), 0) AS avg_quality
+FROM ROLLUP_DEPARTMENT_MONTH r
+JOIN DIM_DEPARTMENT d ON r.DEPARTMENT_ID = d.DEPARTMENT_ID
+GROUP BY d.department_name
+HAVING SUM(r.QUALITY_COUNT) > 0
+ORDER BY 2 DESC;
+""",
+    'difficulty_by_department': """
+SELECT 
+    d.department_name AS department_name, 
+    SUM(r.DIFFICULTY_SUM) / NULLIF(SUM(r.DIFFICULTY_COUNT), 0) AS avg_difficulty
+FROM ROLLUP_DEPARTMENT_MONTH r
+JOIN DIM_DEPARTMENT d ON r.DEPARTMENT_ID = d.DEPARTMENT_ID
+GROUP BY d.department_name
+HAVING SUM(r.DIFFICULTY_COUNT) > 0
+ORDER BY 2 DESC;
+""",
+    'quality_over_time': """
+SELECT
+    MONTH AS month, 
+    SUM(QUALITY_SUM) / NULLIF(SUM(QUALITY_COUNT), 0) AS avg_quality
+FROM ROLLUP_DEPARTMENT_MONTH
+GROUP BY month
+HAVING SUM(QUALITY_COUNT) > 0
+ORDER BY month;
+""",
+    'difficulty_over_time': """
+SELECT 
+    MONTH AS month, 
+    SUM(DIFFICULTY_SUM) / NULLIF(SUM(DIFFICULTY_COUNT), 0) AS avg_difficulty
+FROM ROLLUP_DEPARTMENT_MONTH
+GROUP BY month
+HAVING SUM(DIFFICULTY_COUNT) > 0
+ORDER BY month;
+""",
+    'sentiment_time': """
+SELECT 
+    MONTH AS month, 
+    SUM(SENTIMENT_SUM) / NULLIF(SUM(SENTIMENT_COUNT), 0) AS avg_sentiment
+FROM ROLLUP_DEPARTMENT_MONTH
+GROUP BY month
+ORDER BY month;
+""",
+    'grade_distribution': """
+SELECT 
+    GRADE, 
+    SUM(REVIEW_COUNT) AS count
+FROM ROLLUP_CLASS_GRADE
+WHERE GRADE IS NOT NULL
+GROUP BY GRADE
+ORDER BY count DESC;
+""",
+    'departments': """
+SELECT DISTINCT department_name 
+FROM DIM_DEPARTMENT
+ORDER BY department_name;
+""",
+    # Top-quality classes
+    'top_quality': """
+SELECT 
+    c.course_code AS course_code, 
+    SUM(r.QUALITY_SUM) / NULLIF(SUM(r.QUALITY_COUNT), 0) AS avg_quality
+FROM ROLLUP_CLASS_MONTH AS r
+JOIN DIM_CLASS AS c ON r.CLASS_ID = c.CLASS_ID
+JOIN DIM_DEPARTMENT AS d ON r.DEPARTMENT_ID = d.DEPARTMENT_ID
+WHERE d.DEPARTMENT_NAME = ?
+    AND r.MONTH >= DATE_TRUNC('month', CURRENT_DATE - INTERVAL '5 YEAR')
+GROUP BY course_code
+ORDER BY avg_quality DESC
+LIMIT 5;
+""",
+    # Top-difficulty classes
+    'top_difficulty': """
+SELECT 
+    c.course_code AS course_code, 
+    SUM(r.DIFFICULTY_SUM) / NULLIF(SUM(r.DIFFICULTY_COUNT), 0) AS avg_difficulty
+FROM ROLLUP_CLASS_MONTH AS r
+JOIN DIM_CLASS AS c ON r.CLASS_ID = c.CLASS_ID
+JOIN DIM_DEPARTMENT AS d ON r.DEPARTMENT_ID = d.DEPARTMENT_ID
+WHERE d.DEPARTMENT_NAME = ?
+GROUP BY course_code
+ORDER BY avg_difficulty DESC
+LIMIT 5;
+""",
+    # Top professors
+    'top_professors_by_quality': """
+SELECT 
+    p.professor_name AS professor_name, 
+    SUM(r.QUALITY_SUM) / NULLIF(SUM(r.QUALITY_COUNT), 0) AS avg_quality,
+    SUM(r.REVIEW_COUNT) AS review_count
+FROM ROLLUP_PROFESSOR_MONTH AS r
+JOIN DIM_PROFESSOR AS p ON r.PROFESSOR_ID = p.PROFESSOR_ID
+JOIN DIM_DEPARTMENT AS d ON r.DEPARTMENT_ID = d.DEPARTMENT_ID
+WHERE d.DEPARTMENT_NAME = ?
+    AND r.MONTH >= DATE_TRUNC('month', CURRENT_DATE - INTERVAL '5 YEAR')
+GROUP BY professor_name
+ORDER BY avg_quality DESC, review_count DESC
+LIMIT 5;
+""",
+    'top_professors_easiness': """
+SELECT 
+    p.professor_name AS professor_name, 
+    SUM(r.DIFFICULTY_SUM) / NULLIF(SUM(r.DIFFICULTY_COUNT), 0) AS avg_difficulty,
+    SUM(r.REVIEW_COUNT) AS review_count
+FROM ROLLUP_PROFESSOR_MONTH AS r
+JOIN DIM_PROFESSOR AS p ON r.PROFESSOR_ID = p.PROFESSOR_ID
+JOIN DIM_DEPARTMENT AS d ON r.DEPARTMENT_ID = d.DEPARTMENT_ID
+WHERE d.DEPARTMENT_NAME = ?
+    AND r.MONTH >= DATE_TRUNC('month', CURRENT_DATE - INTERVAL '5 YEAR')
+GROUP BY professor_name
+ORDER BY avg_difficulty ASC, review_count DESC
+LIMIT 5;
+""",
+    # Sentiment within department
+    'department_sentiment': """
+SELECT 
+    SUM(r.SENTIMENT_SUM) / NULLIF(SUM(r.SENTIMENT_COUNT), 0) AS avg_sentiment
+FROM ROLLUP_DEPARTMENT_MONTH AS r 
+JOIN DIM_DEPARTMENT AS d ON r.DEPARTMENT_ID = d.DEPARTMENT_ID
+WHERE d.DEPARTMENT_NAME = ?
+    AND r.MONTH >= DATE_TRUNC('month', CURRENT_DATE - INTERVAL '5 YEAR');
+""",
+    'department_sentiment_trend': """
+SELECT 
+    YEAR(r.MONTH) AS year, 
+    SUM(r.SENTIMENT_SUM) / NULLIF(SUM(r.SENTIMENT_COUNT), 0) AS avg_sentiment
+FROM ROLLUP_DEPARTMENT_MONTH AS r
+JOIN DIM_DEPARTMENT AS d ON r.DEPARTMENT_ID = d.DEPARTMENT_ID
+WHERE d.DEPARTMENT_NAME = ?
+    AND r.MONTH >= DATE_TRUNC('month', CURRENT_DATE - INTERVAL '5 YEAR')
+GROUP BY year
+ORDER BY year;
+""",
+    'classes': """
+SELECT DISTINCT 
+    c.COURSE_CODE AS course_code
+FROM ROLLUP_CLASS_MONTH AS r
+JOIN DIM_CLASS AS c ON r.CLASS_ID = c.CLASS_ID
+JOIN DIM_DEPARTMENT AS d ON r.DEPARTMENT_ID = d.DEPARTMENT_ID
+WHERE d.DEPARTMENT_NAME = ?
+ORDER BY course_code;
+""",
+    # Top professors for the class
+    'top_professors_class': """
+SELECT 
+    p.professor_name AS professor_name, 
+    SUM(r.QUALITY_SUM) / NULLIF(SUM(r.QUALITY_COUNT), 0) AS avg_quality, 
+    SUM(r.DIFFICULTY_SUM) / NULLIF(SUM(r.DIFFICULTY_COUNT), 0) AS avg_difficulty, 
+    SUM(r.SENTIMENT_SUM) / NULLIF(SUM(r.SENTIMENT_COUNT), 0) AS avg_sentiment,
+    SUM(r.REVIEW_COUNT) AS review_count
+FROM ROLLUP_CLASS_PROFESSOR AS r
+JOIN DIM_CLASS AS c ON r.CLASS_ID = c.CLASS_ID
+JOIN DIM_PROFESSOR AS p ON r.PROFESSOR_ID = p.PROFESSOR_ID
+WHERE c.COURSE_CODE = ?
+GROUP BY professor_name
+ORDER BY avg_quality DESC, review_count DESC;
+""",
+    # Trend of metrics over time
+    'metrics_trend': """
+SELECT 
+    YEAR(r.MONTH) AS year, 
+    SUM(r.QUALITY_SUM) / NULLIF(SUM(r.QUALITY_COUNT), 0) AS avg_quality, 
+    SUM(r.DIFFICULTY_SUM) / NULLIF(SUM(r.DIFFICULTY_COUNT), 0) AS avg_difficulty
+FROM ROLLUP_CLASS_MONTH AS r
+JOIN DIM_CLASS AS c ON r.CLASS_ID = c.CLASS_ID
+WHERE c.COURSE_CODE = ?
+GROUP BY year
+ORDER BY year;
+""",
+    'class_sentiment_trend': """
+SELECT 
+    YEAR(r.MONTH) AS year, 
+    SUM(r.SENTIMENT_SUM) / NULLIF(SUM(r.SENTIMENT_COUNT), 0) AS avg_sentiment
+FROM ROLLUP_CLASS_MONTH AS r
+JOIN DIM_CLASS AS c ON r.CLASS_ID = c.CLASS_ID
+WHERE c.COURSE_CODE = ?
+GROUP BY year
+ORDER BY year
+""",
+    # Grade distribution query
+    'grade_distribution_class': """
+SELECT 
+    r.GRADE AS grade, 
+    SUM(r.REVIEW_COUNT) AS count
+FROM ROLLUP_CLASS_GRADE AS r
+JOIN DIM_CLASS AS c ON r.CLASS_ID = c.CLASS_ID
+WHERE c.COURSE_CODE = ?
+GROUP BY grade
+ORDER BY count DESC;
+""",
+}